@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+"""
+Time NitrileTranslator's tree walk on test/sample/sample-mem.rst with
+its chapters repeated ``--scale`` times::
+
+  $ python bench/bench_dispatch.py --scale 50 --memory
+
+``--memory`` also reports (with tracemalloc, Python 3) the memory the
+translator holds after the walk and the peak while ``get_whole``
+joins the output.
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchlib import SAMPLE_DIR, count_nodes, parse, quiet
+import rst2nitrile
+
+FIRST_CHAPTER = 'Using ``rst`` for Books\n'
+
+
+def scaled_sample(scale, dirname):
+    """
+    Write the sample with its chapters repeated ``scale`` times into
+    ``dirname`` (with its images) and return the path
+    """
+    with open(os.path.join(SAMPLE_DIR, 'sample-mem.rst')) as fin:
+        text = fin.read()
+    idx = text.index(FIRST_CHAPTER)
+    path = os.path.join(dirname, 'sample-scaled.rst')
+    with open(path, 'w') as fout:
+        fout.write(text[:idx] + text[idx:] * scale)
+    for name in os.listdir(SAMPLE_DIR):
+        if name.endswith('.png'):
+            shutil.copy(os.path.join(SAMPLE_DIR, name), dirname)
+    return path
+
+
+def time_walk(document, repeat):
+    best = None
+    for _ in range(repeat):
+        with quiet():
+            start = time.time()
+            visitor = rst2nitrile.NitrileTranslator(document)
+            document.walkabout(visitor)
+            visitor.get_whole()
+            elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def walk_memory(document):
+    """
+    (bytes allocated by the walk still held after it, peak bytes up to
+    the end of ``get_whole``) for one translation
+    """
+    import tracemalloc
+    with quiet():
+        tracemalloc.start()
+        try:
+            visitor = rst2nitrile.NitrileTranslator(document)
+            document.walkabout(visitor)
+            held = tracemalloc.get_traced_memory()[0]
+            visitor.get_whole()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return held, peak
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--memory', action='store_true',
+                        help='report memory used by a translation')
+    opts = parser.parse_args(args)
+    dirname = tempfile.mkdtemp()
+    try:
+        source = scaled_sample(opts.scale, dirname)
+        document = parse(source, os.path.join(dirname, 'out.tex'))
+        nodes = count_nodes(document)
+        best = time_walk(document, opts.repeat)
+        memory = walk_memory(document) if opts.memory else None
+    finally:
+        shutil.rmtree(dirname)
+    print('{0} nodes, best of {1}: {2:.3f}s, {3:.0f} nodes/sec'.format(
+        nodes, opts.repeat, best, nodes / best))
+    if memory:
+        print('held after the walk: {0:.1f}MB, peak with get_whole: '
+              '{1:.1f}MB'.format(memory[0] / 1e6, memory[1] / 1e6))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
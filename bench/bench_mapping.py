@@ -0,0 +1,105 @@
+#!/usr/bin/env python
+"""
+Compare the translator walk with the built-in mappings against house
+styles loaded with --template-file::
+
+  $ python bench/bench_mapping.py --scale 50
+
+A house style is written for each built-in mapping with every pair
+(table codes included) changed, then each mapping is timed on
+bench_dispatch.py's scaled sample, best of ``--repeat``.  Loading and
+checking a template file is timed separately: it happens once per
+file, not per node.
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchlib import count_nodes, parse, quiet
+from bench_dispatch import scaled_sample
+import rst2nitrile
+
+
+def house_style(base):
+    """
+    A --template-file over ``base`` wrapping every pair in house macros
+    """
+    style = {'base': base}
+    for name, (begin, end) in rst2nitrile.BUILTIN_MAPPINGS[base].items():
+        if begin is None and end is None:
+            continue
+        if name in rst2nitrile.TABLE_CODES:
+            style[name] = [begin + r'\housetable ', r'\endhousetable ' + end]
+        else:
+            style[name] = [r'\housebegin{' + name + '}' + (begin or ''),
+                           (end or '') + r'\houseend{' + name + '}']
+    return style
+
+
+def time_walks(document, templates, repeat):
+    """
+    Best walk time with each template, taking turns so a slower stretch
+    of the machine hits them alike
+    """
+    best = [None] * len(templates)
+    for _ in range(repeat):
+        for idx, template in enumerate(templates):
+            with quiet():
+                start = time.time()
+                visitor = rst2nitrile.NitrileTranslator(document, template)
+                document.walkabout(visitor)
+                visitor.get_whole()
+                elapsed = time.time() - start
+            if best[idx] is None or elapsed < best[idx]:
+                best[idx] = elapsed
+    return best
+
+
+def time_load(path, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        rst2nitrile.load_template(path)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--scale', type=int, default=50)
+    parser.add_argument('--repeat', type=int, default=5)
+    opts = parser.parse_args(args)
+    dirname = tempfile.mkdtemp()
+    rows = []
+    try:
+        source = scaled_sample(opts.scale, dirname)
+        document = parse(source, os.path.join(dirname, 'out.tex'))
+        nodes = count_nodes(document)
+        for base in sorted(rst2nitrile.BUILTIN_MAPPINGS):
+            path = os.path.join(dirname, 'house-{0}.json'.format(base))
+            with io.open(path, 'w', encoding='utf-8') as fout:
+                fout.write(json.dumps(house_style(base), indent=2,
+                                      ensure_ascii=False))
+            builtin, house = time_walks(
+                document, [rst2nitrile.get_template(base),
+                           rst2nitrile.get_template(path)], opts.repeat)
+            rows.append((base, builtin, house, time_load(path, opts.repeat)))
+    finally:
+        shutil.rmtree(dirname)
+    print('{0} nodes, best of {1}'.format(nodes, opts.repeat))
+    print('{0:<10} {1:>10} {2:>10} {3:>8} {4:>10}'.format(
+        'base', 'built-in s', 'house s', 'ratio', 'load ms'))
+    for base, builtin, house, load in rows:
+        print('{0:<10} {1:>10.3f} {2:>10.3f} {3:>7.2f}x {4:>10.2f}'.format(
+            base, builtin, house, house / builtin, load * 1000))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+"""
+Time the rst -> LaTeX pipeline on a generated manuscript, phase by phase::
+
+  $ python bench/bench_pipeline.py --chapters 40 --json before.json
+  $ python bench/bench_pipeline.py --chapters 40 --compare before.json
+
+Phases are the docutils parse, the translator walk, ``get_whole`` and
+writing the .tex file.  The manuscript mixes paragraphs, literal
+blocks, tables, longtables, footnotes, index entries and images in
+proportions set with ``--mix``.
+"""
+from __future__ import print_function
+import argparse
+import io
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchlib import ROOT, SAMPLE_DIR, count_nodes, parse, quiet
+import docutils
+import rst2nitrile
+
+DEFAULT_MIX = 'paragraph=20,literal=5,table=2,longtable=1,footnote=3,index=4,image=1'
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit nullam '
+         'molestie venenatis varius nulla interdum porttitor erat at '
+         'adipiscing arcu metus porta vel vestibulum sapien donec tincidunt '
+         'placerat imperdiet').split()
+
+PREAMBLE = """\
+Generated Benchmark Book
+========================
+
+.. raw:: latexpreamble
+
+  \\documentclass[10pt]{memoir}
+  \\usepackage{graphicx}
+  \\usepackage{makeidx}
+  \\makeindex
+  \\usepackage{tabulary}
+  \\usepackage{longtable}
+  \\usepackage{listings}
+  \\usepackage{mdframed}
+  \\usepackage[linktocpage=true]{hyperref}
+  \\begin{document}
+
+"""
+
+
+def parse_mix(text):
+    mix = []
+    for item in text.split(','):
+        name, weight = item.split('=')
+        mix.append((name.strip(), int(weight)))
+    return mix
+
+
+class Manuscript(object):
+    """
+    Generates rst with a repeatable (seeded) mix of constructs
+    """
+    def __init__(self, mix, seed=0):
+        self.mix = mix
+        self.random = random.Random(seed)
+        self.footnotes = 0
+        self.terms = 0
+
+    def words(self, count):
+        words = [self.random.choice(WORDS) for _ in range(count)]
+        words[0] = words[0].capitalize()
+        return ' '.join(words)
+
+    def inline(self):
+        # sprinkle inline markup and escapable characters through the text
+        parts = []
+        for _ in range(self.random.randint(4, 8)):
+            kind = self.random.randint(0, 5)
+            text = self.words(self.random.randint(3, 10))
+            if kind == 1:
+                text += ' *{0}*'.format(self.random.choice(WORDS))
+            elif kind == 2:
+                text += ' **{0}**'.format(self.random.choice(WORDS))
+            elif kind == 3:
+                text += ' ``{0}_{1}()``'.format(self.random.choice(WORDS),
+                                                self.random.choice(WORDS))
+            elif kind == 4:
+                text += ' costs 10% & #1'
+            parts.append(text + '.')
+        return '\n'.join(parts)
+
+    def paragraph(self):
+        return self.inline() + '\n'
+
+    def literal(self):
+        lines = ['    {0}({1}) = {{"{2}": {3}}}'.format(
+            self.random.choice(WORDS), self.random.choice(WORDS),
+            self.random.choice(WORDS), self.random.randint(0, 999))
+            for _ in range(self.random.randint(3, 30))]
+        return 'Code::\n\n' + '\n'.join(lines) + '\n'
+
+    def _table(self, rows):
+        cols = self.random.randint(2, 4)
+        border = '  '.join(['=' * 12] * cols)
+        out = ['.. table:: {0}'.format(self.words(4)), '',
+               '   ' + border,
+               '   ' + '  '.join('{0:<12}'.format(w[:12]) for w in
+                                  self.random.sample(WORDS, cols)),
+               '   ' + border]
+        for _ in range(rows):
+            out.append('   ' + '  '.join(
+                '{0:<12}'.format(self.random.choice(WORDS)[:12])
+                for _ in range(cols)))
+        out.append('   ' + border)
+        return '\n'.join(out) + '\n'
+
+    def table(self):
+        return self._table(self.random.randint(3, 8))
+
+    def longtable(self):
+        return '.. longtable:\n\n' + self._table(self.random.randint(40, 120))
+
+    def footnote(self):
+        self.footnotes += 1
+        return '{0} [#]_.\n\n.. [#] {1}.\n'.format(
+            self.words(12), self.words(8))
+
+    def index(self):
+        self.terms += 1
+        return ('.. index::\n   single: {0} {1}\n   pair: {2}; {3}\n'.format(
+            self.random.choice(WORDS), self.terms,
+            self.random.choice(WORDS), self.random.choice(WORDS)))
+
+    def image(self):
+        return '.. image:: blue.png\n   :width: {0}%\n'.format(
+            self.random.choice([30, 50, 80]))
+
+    def block(self):
+        total = sum(weight for _, weight in self.mix)
+        pick = self.random.uniform(0, total)
+        for name, weight in self.mix:
+            pick -= weight
+            if pick <= 0:
+                break
+        return getattr(self, name)()
+
+    def generate(self, chapters, sections, blocks):
+        out = [PREAMBLE]
+        for chapter in range(chapters):
+            title = 'Chapter {0} {1}'.format(chapter, self.words(3))
+            out.append('{0}\n{1}\n'.format(title, '=' * len(title)))
+            for section in range(sections):
+                title = 'Section {0}.{1} {2}'.format(chapter, section,
+                                                     self.words(2))
+                out.append('{0}\n{1}\n'.format(title, '-' * len(title)))
+                for _ in range(blocks):
+                    out.append(self.block())
+        return '\n'.join(out)
+
+
+def peak_rss_kb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        rss //= 1024  # bytes there
+    return rss
+
+
+def timed(results, name, func, nodes=None, size=None):
+    start = time.time()
+    value = func()
+    elapsed = time.time() - start
+    phase = {'seconds': elapsed, 'peak_rss_kb': peak_rss_kb()}
+    if nodes is not None:
+        phase['nodes_per_sec'] = nodes / elapsed if elapsed else None
+    if size is not None:
+        phase['mb_per_sec'] = size / 1e6 / elapsed if elapsed else None
+    results[name] = phase
+    return value
+
+
+def run(opts, dirname):
+    manuscript = Manuscript(parse_mix(opts.mix), opts.seed)
+    text = manuscript.generate(opts.chapters, opts.sections, opts.blocks)
+    source = os.path.join(dirname, 'book.rst')
+    with io.open(source, 'w', encoding='utf-8') as fout:
+        fout.write(text)
+    shutil.copy(os.path.join(SAMPLE_DIR, 'blue.png'), dirname)
+    destination = os.path.join(dirname, 'build', 'book.tex')
+    os.makedirs(os.path.dirname(destination))
+    source_size = len(text.encode('utf-8'))
+
+    phases = {}
+    document = timed(phases, 'parse',
+                     lambda: parse(source, destination), size=source_size)
+    nodes = count_nodes(document)
+    phases['parse']['nodes_per_sec'] = nodes / phases['parse']['seconds']
+    with quiet():
+        visitor = rst2nitrile.NitrileTranslator(document)
+        visitor.image_stager = rst2nitrile.ImageStager(
+            document.settings.image_jobs, document.settings.image_check)
+
+        def walk():
+            document.walkabout(visitor)
+            visitor.image_stager.close()
+        timed(phases, 'translate', walk, nodes=nodes)
+    whole = timed(phases, 'get_whole', visitor.get_whole)
+    data = whole.encode('utf-8')
+    phases['get_whole']['mb_per_sec'] = (
+        len(data) / 1e6 / phases['get_whole']['seconds'])
+
+    def write():
+        with open(destination, 'wb') as fout:
+            fout.write(data)
+    timed(phases, 'write', write, size=len(data))
+    return {
+        'commit': git_commit(),
+        'python': platform.python_version(),
+        'docutils': docutils.__version__,
+        'config': {'chapters': opts.chapters, 'sections': opts.sections,
+                   'blocks': opts.blocks, 'mix': opts.mix,
+                   'seed': opts.seed},
+        'source_bytes': source_size,
+        'output_bytes': len(data),
+        'nodes': nodes,
+        'phases': phases,
+        'peak_rss_kb': peak_rss_kb(),
+    }
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT,
+            stderr=open(os.devnull, 'w')).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+PHASES = ['parse', 'translate', 'get_whole', 'write']
+
+
+def report(result, baseline=None):
+    print('{0} nodes, {1:.2f}MB rst -> {2:.2f}MB tex, peak RSS {3}MB'.format(
+        result['nodes'], result['source_bytes'] / 1e6,
+        result['output_bytes'] / 1e6, result['peak_rss_kb'] // 1024))
+    header = '{0:<10} {1:>9} {2:>12} {3:>9}'.format(
+        'phase', 'seconds', 'nodes/sec', 'MB/sec')
+    if baseline:
+        header += ' {0:>9}'.format('vs ' + (baseline.get('commit') or 'base'))
+    print(header)
+    for name in PHASES:
+        phase = result['phases'][name]
+        line = '{0:<10} {1:>9.3f} {2:>12} {3:>9}'.format(
+            name, phase['seconds'],
+            '{0:.0f}'.format(phase['nodes_per_sec'])
+            if phase.get('nodes_per_sec') else '',
+            '{0:.1f}'.format(phase['mb_per_sec'])
+            if phase.get('mb_per_sec') else '')
+        if baseline:
+            old = baseline['phases'][name]['seconds']
+            line += ' {0:>8.2f}x'.format(old / phase['seconds']
+                                         if phase['seconds'] else 0)
+        print(line)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--chapters', type=int, default=20)
+    parser.add_argument('--sections', type=int, default=5)
+    parser.add_argument('--blocks', type=int, default=30,
+                        help='blocks per section')
+    parser.add_argument('--mix', default=DEFAULT_MIX,
+                        help='relative weights of each construct '
+                             '(default %(default)s)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='show speedups against the '
+                                          'results in this JSON file')
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the generated files (printed)')
+    opts = parser.parse_args(args)
+    dirname = tempfile.mkdtemp()
+    try:
+        result = run(opts, dirname)
+    finally:
+        if opts.keep:
+            print('Files in', dirname)
+        else:
+            shutil.rmtree(dirname)
+    baseline = None
+    if opts.compare:
+        with open(opts.compare) as fin:
+            baseline = json.load(fin)
+    report(result, baseline)
+    if opts.json:
+        with open(opts.json, 'w') as fout:
+            json.dump(result, fout, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
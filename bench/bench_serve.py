@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+"""
+Compare converting the sample with a fresh ``rst2nitrile.py`` process
+against posting it to ``rst2nitrile.py --serve``::
+
+  $ python bench/bench_serve.py --requests 200 --concurrency 8
+
+Prints the mean and 95th percentile latency of each, then the server's
+``/stats``.
+"""
+from __future__ import print_function
+import argparse
+import json
+import multiprocessing.pool
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchlib import ROOT, SAMPLE_DIR
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:  # Python 2
+    from urllib2 import Request, urlopen
+
+SCRIPT = os.path.join(ROOT, 'rst2nitrile.py')
+
+
+def summary(latencies):
+    latencies = sorted(latencies)
+    return 'mean {0:.3f}s, p95 {1:.3f}s'.format(
+        sum(latencies) / len(latencies),
+        latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))])
+
+
+def free_port():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def cold(source, count):
+    dirname = tempfile.mkdtemp()
+    latencies = []
+    try:
+        with open(os.devnull, 'w') as devnull:
+            for _ in range(count):
+                start = time.time()
+                subprocess.check_call(
+                    [sys.executable, SCRIPT, '-r', '5', source,
+                     os.path.join(dirname, 'out.tex')],
+                    stdout=devnull, stderr=devnull)
+                latencies.append(time.time() - start)
+    finally:
+        shutil.rmtree(dirname)
+    return latencies
+
+
+def wait_for(url, timeout=30):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            return urlopen(url).read()
+        except IOError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def served(data, count, concurrency, jobs):
+    port = free_port()
+    url = 'http://127.0.0.1:{0}/'.format(port)
+    with open(os.devnull, 'w') as devnull:
+        server = subprocess.Popen(
+            [sys.executable, SCRIPT, '--serve', str(port),
+             '--serve-jobs', str(jobs), '-r', '5'],
+            stdout=devnull, stderr=devnull)
+    try:
+        wait_for(url + 'stats')
+
+        def post(_):
+            start = time.time()
+            urlopen(Request(url, data=data)).read()
+            return time.time() - start
+        pool = multiprocessing.pool.ThreadPool(concurrency)
+        try:
+            latencies = pool.map(post, range(count), chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        stats = json.loads(wait_for(url + 'stats').decode('utf-8'))
+    finally:
+        server.terminate()
+        server.wait()
+    return latencies, stats
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--requests', type=int, default=100)
+    parser.add_argument('--cold', type=int, default=10,
+                        help='fresh processes to time')
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--jobs', type=int,
+                        default=multiprocessing.cpu_count(),
+                        help='--serve-jobs')
+    opts = parser.parse_args(args)
+    source = os.path.join(SAMPLE_DIR, 'sample-mem.rst')
+    with open(source, 'rb') as fin:
+        data = fin.read()
+    print('fresh process: ' + summary(cold(source, opts.cold)))
+    latencies, stats = served(data, opts.requests, opts.concurrency,
+                              opts.jobs)
+    print('--serve, {0} at a time: {1}'.format(opts.concurrency,
+                                               summary(latencies)))
+    print(json.dumps(stats, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
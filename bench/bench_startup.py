@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+"""
+Time how long ``rst2nitrile.py`` takes to start and to convert a small
+document::
+
+  $ python bench/bench_startup.py --repeat 20
+
+Prints the slowest imports of ``import rst2nitrile`` (from
+``python -X importtime``) and the best of ``--repeat`` runs converting
+a one paragraph document, next to a bare ``python -c pass``.  Exits
+with status 1 when the conversion is slower than ``--target-ms``.
+"""
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from benchlib import ROOT
+
+SCRIPT = os.path.join(ROOT, 'rst2nitrile.py')
+
+SMALL_DOC = """\
+Small Document
+==============
+
+A paragraph with *emphasis*, ``code`` and a list:
+
+* one
+* two
+"""
+
+
+def env():
+    environ = dict(os.environ)
+    path = [ROOT] + [p for p in [environ.get('PYTHONPATH')] if p]
+    environ['PYTHONPATH'] = os.pathsep.join(path)
+    return environ
+
+
+def import_times():
+    """
+    ``(self us, cumulative us, depth, module)`` for each import
+    """
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime', '-c',
+                             'import rst2nitrile'],
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            env=env())
+    err = proc.communicate()[1].decode('utf-8')
+    times = []
+    for line in err.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        own, total, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip())) // 2
+        times.append((int(own), int(total), depth, name.strip()))
+    return times
+
+
+def best_run(args, repeat):
+    best = None
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(repeat):
+            start = time.time()
+            subprocess.check_call(args, stdout=devnull, stderr=devnull,
+                                  env=env())
+            elapsed = time.time() - start
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--top', type=int, default=15,
+                        help='imports to list')
+    parser.add_argument('--target-ms', type=float, default=250,
+                        help='fail when the small document takes longer '
+                             '(default %(default)s)')
+    opts = parser.parse_args(args)
+    times = import_times()
+    total = [t for t in times if t[3] == 'rst2nitrile'][0][1]
+    print('import rst2nitrile: {0:.1f}ms'.format(total / 1000.0))
+    print('{0:>10} {1:>10}  {2}'.format('self ms', 'total ms', 'module'))
+    direct = sorted((t for t in times if t[2] == 1),
+                    key=lambda t: -t[1])
+    for own, cumulative, _, name in direct[:opts.top]:
+        print('{0:>10.1f} {1:>10.1f}  {2}'.format(own / 1000.0,
+                                                   cumulative / 1000.0, name))
+    dirname = tempfile.mkdtemp()
+    try:
+        source = os.path.join(dirname, 'small.rst')
+        with open(source, 'w') as fout:
+            fout.write(SMALL_DOC)
+        python = best_run([sys.executable, '-c', 'pass'], opts.repeat)
+        small = best_run([sys.executable, SCRIPT, source,
+                          os.path.join(dirname, 'small.tex')], opts.repeat)
+    finally:
+        shutil.rmtree(dirname)
+    print('small document: {0:.0f}ms (python -c pass: {1:.0f}ms), best '
+          'of {2}'.format(small * 1000, python * 1000, opts.repeat))
+    if small * 1000 > opts.target_ms:
+        print('slower than the {0:.0f}ms target'.format(opts.target_ms))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
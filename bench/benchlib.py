@@ -0,0 +1,49 @@
+"""
+Helpers shared by the benchmarks
+"""
+import contextlib
+import os
+import sys
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+SAMPLE_DIR = os.path.join(ROOT, 'test', 'sample')
+sys.path.insert(0, ROOT)
+
+import rst2nitrile
+
+
+def parse(source, destination, **overrides):
+    """
+    Parse ``source`` the way ``main()`` does and return the document
+    (``destination`` is where images get copied)
+    """
+    publisher = rst2nitrile.make_publisher()
+    overrides.setdefault('report_level', 5)
+    publisher.get_settings(**overrides)
+    publisher.settings._source = source
+    publisher.settings._destination = destination
+    publisher.set_io()
+    document = publisher.reader.read(publisher.source, publisher.parser,
+                                     publisher.settings)
+    publisher.document = document
+    publisher.apply_transforms()
+    return document
+
+
+def count_nodes(document):
+    return sum(1 for _ in rst2nitrile._findall(document, None))
+
+
+@contextlib.contextmanager
+def quiet():
+    """
+    Send stdout (the translator's debugging output) to /dev/null
+    """
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
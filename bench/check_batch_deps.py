@@ -0,0 +1,90 @@
+#!/usr/bin/env python
+"""
+Convert two documents with ``--batch --deps-file {}.json`` and check
+each manifest lists only the files of its own document::
+
+  $ python bench/check_batch_deps.py --batch-jobs 2
+
+The first document includes a file and uses an image, the second uses
+neither.  Exits with status 1 when a manifest is missing or the inputs
+of the two overlap beyond what they share on purpose (nothing).
+"""
+from __future__ import print_function
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from benchlib import ROOT, SAMPLE_DIR
+
+SCRIPT = os.path.join(ROOT, 'rst2nitrile.py')
+
+BOOK = """\
+Book
+====
+
+.. include:: inc.rst
+
+.. image:: blue.png
+"""
+
+INCLUDED = """\
+Included paragraph.
+"""
+
+CODE = """\
+Code
+====
+
+A paragraph and a listing::
+
+  print('code')
+"""
+
+
+def inputs(path):
+    with open(path) as fin:
+        manifest = json.load(fin)
+    return set((item['kind'], os.path.basename(item['path']))
+               for item in manifest['inputs'])
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--batch-jobs', type=int, default=1)
+    opts = parser.parse_args(args)
+    dirname = tempfile.mkdtemp()
+    try:
+        for name, text in [('book.rst', BOOK), ('inc.rst', INCLUDED),
+                           ('code.rst', CODE)]:
+            with open(os.path.join(dirname, name), 'w') as fout:
+                fout.write(text)
+        shutil.copy(os.path.join(SAMPLE_DIR, 'blue.png'), dirname)
+        os.mkdir(os.path.join(dirname, 'build'))
+        with open(os.path.join(dirname, 'books.txt'), 'w') as fout:
+            fout.write('book.rst build/book.tex\ncode.rst build/code.tex\n')
+        with open(os.devnull, 'w') as devnull:
+            subprocess.check_call(
+                [sys.executable, SCRIPT, '--batch', 'books.txt',
+                 '--batch-jobs', str(opts.batch_jobs),
+                 '--deps-file', '{}.json', '-r', '5'],
+                cwd=dirname, stdout=devnull)
+        book = inputs(os.path.join(dirname, 'build', 'book.json'))
+        code = inputs(os.path.join(dirname, 'build', 'code.json'))
+    finally:
+        shutil.rmtree(dirname)
+    print('book.rst:', ', '.join(sorted(' '.join(item) for item in book)))
+    print('code.rst:', ', '.join(sorted(' '.join(item) for item in code)))
+    shared = book & code
+    if shared:
+        print('both manifests list', ', '.join(sorted(
+            ' '.join(item) for item in shared)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
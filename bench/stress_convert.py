@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+"""
+Call rst2nitrile.convert() from many threads at once and check every
+result matches a serial conversion of the same document::
+
+  $ python bench/stress_convert.py --threads 8 --rounds 5
+
+Documents are generated like bench_pipeline.py's, each with its own
+options (chapters or not, titles, longtables, listing engine), so
+state leaking between conversions shows up as a mismatch.  Exits with
+status 1 when any output differs.
+"""
+from __future__ import print_function
+import argparse
+import multiprocessing.pool
+import random
+import sys
+import time
+
+from benchlib import quiet
+from bench_pipeline import DEFAULT_MIX, Manuscript, parse_mix
+import rst2nitrile
+
+OPTION_SETS = [
+    {},
+    {'no_chapters': True},
+    {'add_title': True},
+    {'longtable_rows': 5},
+    {'listing_engine': 'verbatim'},
+    {'no_chapters': True, 'longtable_rows': 0, 'longtable_chars': 0},
+]
+
+
+def make_jobs(count, mix):
+    jobs = []
+    for seed in range(count):
+        text = Manuscript(parse_mix(mix), seed).generate(2, 2, 10)
+        jobs.append((text, OPTION_SETS[seed % len(OPTION_SETS)]))
+    return jobs
+
+
+def convert(job):
+    text, options = job
+    return rst2nitrile.convert(text, report_level=5, **options)
+
+
+def main(args):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--docs', type=int, default=12)
+    parser.add_argument('--rounds', type=int, default=5,
+                        help='times each document is converted concurrently')
+    parser.add_argument('--mix', default=DEFAULT_MIX)
+    parser.add_argument('--seed', type=int, default=0,
+                        help='for the order of the concurrent calls')
+    opts = parser.parse_args(args)
+    jobs = make_jobs(opts.docs, opts.mix)
+    with quiet():
+        start = time.time()
+        expected = [convert(job) for job in jobs]
+        serial = time.time() - start
+        order = list(range(len(jobs))) * opts.rounds
+        random.Random(opts.seed).shuffle(order)
+        pool = multiprocessing.pool.ThreadPool(opts.threads)
+        try:
+            start = time.time()
+            results = pool.map(convert, [jobs[idx] for idx in order],
+                               chunksize=1)
+            threaded = time.time() - start
+        finally:
+            pool.close()
+            pool.join()
+    mismatches = sum(1 for idx, result in zip(order, results)
+                     if result != expected[idx])
+    print('{0} documents: serial {1:.1f}/s, {2} threads {3:.1f}/s'.format(
+        len(jobs), len(jobs) / serial, opts.threads,
+        len(order) / threaded))
+    print('{0} of {1} concurrent conversions differ from the serial '
+          'output'.format(mismatches, len(order)))
+    return 1 if mismatches else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
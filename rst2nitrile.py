@@ -3,9 +3,19 @@
 # Copyright 2008-2009 Matt Harrison
 # Licensed under Apache License, Version 2.0 (current)
 from __future__ import print_function
+import collections
+import copy
+import gc
+import hashlib
+from io import open as io_open
+import math
 import os
+import re
 import shutil
+import string
 import sys
+import threading
+import time
 
 import docutils
 import docutils.utils #hack around circ. dep in io (docutils.10)
@@ -14,26 +24,68 @@ from docutils.readers import standalone
 from docutils.core import (Publisher, default_description, 
     default_usage)
 from docutils.parsers.rst import Directive, directives, roles
+from docutils.transforms import Transform, Transformer
 
 import nitrile as nt
 
+# Modules only some options need are imported when first used (json,
+# pickle, tempfile, multiprocessing, subprocess, http.server, ...) and
+# Pillow and Pygments by load_pillow() and load_pygments(), to keep
+# startup fast.
+Image = None
+pygments = None
+
+
+def load_pillow():
+    """
+    Import Pillow's Image module, return it or None when Pillow isn't
+    installed
+    """
+    global Image
+    if Image is None:
+        try:
+            from PIL import Image
+        except ImportError:
+            return None
+    return Image
+
+
+def load_pygments():
+    """
+    Import Pygments, return it or None when it isn't installed
+    """
+    global pygments, LatexFormatter, get_lexer_by_name, get_style_by_name
+    global ClassNotFound
+    if pygments is None:
+        try:
+            import pygments.formatters
+            import pygments.lexers
+            import pygments.styles
+            import pygments.util
+        except ImportError:
+            pygments = None
+            return None
+        LatexFormatter = pygments.formatters.LatexFormatter
+        get_lexer_by_name = pygments.lexers.get_lexer_by_name
+        get_style_by_name = pygments.styles.get_style_by_name
+        ClassNotFound = pygments.util.ClassNotFound
+    return pygments
+
 if sys.version_info[0] > 2:
     unicode = str
 
 
 SECTIONS = ['part', 'chapter', 'section', 'subsection', 'subsubsection',
             'subsubsection'] #hack on end
-DEFAULT_SECTION_IDX = 1
-ADD_TITLE = False
+DEFAULT_SECTION_IDX = 1  # chapters, 2 (sections) with --no-chapters
 
 class envvar(nodes.Inline, nodes.TextElement): pass
 def ignore_role(role, rawtext, text, lineno, inliner,
                 options={}, content=[]):
     return [envvar(rawtext, text)], []
 
-# ignore sphinx stuff
-for role in 'envvar,data,term,ref,func,class,meth,doc,attr,mod,paramref,exc'.split(','):
-    roles.register_local_role(role, ignore_role)
+# ignore sphinx stuff (see register_extensions)
+IGNORED_ROLES = 'envvar,data,term,ref,func,class,meth,doc,attr,mod,paramref,exc'.split(',')
 
 class Ignore(Directive):
     has_content = True
@@ -43,8 +95,7 @@ class Ignore(Directive):
         return []
 
 
-for directive in 'autoclass,autodata,automodule,currentmodule,deprecated,function,seealso,toctree,module,autofunction,versionadded,versionchanged'.split(','):
-    directives.register_directive(directive, Ignore)
+IGNORED_DIRECTIVES = 'autoclass,autodata,automodule,currentmodule,deprecated,function,seealso,toctree,module,autofunction,versionadded,versionchanged'.split(',')
 
     
 class Index(Directive):
@@ -57,7 +108,6 @@ class Index(Directive):
     optional_arguments = 1
     final_argument_whitespace = True
     option_spec = {}
-    count = 0
 
     def run(self):
         text = ''.join(self.content)
@@ -66,9 +116,13 @@ class Index(Directive):
         # Parse the directive contents.
         self.state.nested_parse(self.content, self.content_offset,
                                 index_node)
-        targetid = 'index-%s' % Index.count
-        Index.count += 1
+        # numbered per document, so concurrent conversions don't mix
+        document = self.state.document
+        count = getattr(document, 'index_count', 0)
+        document.index_count = count + 1
+        targetid = 'index-%s' % count
         target_node = nodes.target('', '', ids=[targetid])
+        index_node['targetid'] = targetid
         index_node['entries'] = ne = []
         index_node['inline'] = False
         if self.arguments:
@@ -139,20 +193,182 @@ class index(nodes.Invisible, nodes.Inline, nodes.TextElement):
     """
 
 
+_REGISTERED = False
+
+
+def register_extensions():
+    """
+    Register the index directive and the ignored Sphinx roles and
+    directives with docutils, once (when the first Parser is made
+    rather than on import)
+    """
+    global _REGISTERED
+    if _REGISTERED:
+        return
+    for role in IGNORED_ROLES:
+        roles.register_local_role(role, ignore_role)
+    for directive in IGNORED_DIRECTIVES:
+        directives.register_directive(directive, Ignore)
+    directives.register_directive('index', Index)
+    _REGISTERED = True
+
+
 class Parser(docutils.parsers.rst.Parser):
     def __init__(self):
-        directives.register_directive('index', Index)
+        register_extensions()
         docutils.parsers.rst.Parser.__init__(self)
 
 
+class StoreDoctree(Transform):
+    """
+    Save the finished doctree to the ``--doctree-cache``, runs after
+    every other transform
+    """
+    default_priority = 999
+
+    def apply(self):
+        reader = self.document.transformer.components['reader']
+        reader.store(self.document)
+
+
+class CachedTransformer(Transformer):
+    """
+    Transformer for a doctree from the cache, its transforms have run
+    """
+    def populate_from_components(self, components):
+        pass
+
+    def apply_transforms(self):
+        pass
+
+
+class Reader(standalone.Reader):
+    """
+    Standalone reader that loads the doctree from ``--doctree-cache``
+    when the source and everything it includes are unchanged
+    """
+    def __init__(self, *args, **kwargs):
+        standalone.Reader.__init__(self, *args, **kwargs)
+        self.doctree_cache = None
+        self.cache_source = None  # source path to store the doctree for
+        self.deps_start = 0
+
+    def get_transforms(self):
+        transforms = standalone.Reader.get_transforms(self)
+        if self.cache_source:
+            transforms.append(StoreDoctree)
+        return transforms
+
+    def read(self, source, parser, settings):
+        self.cache_source = None
+        path = getattr(source, 'source_path', None)
+        if not settings.doctree_cache or not path or path == '-':
+            return standalone.Reader.read(self, source, parser, settings)
+        cache = self.doctree_cache
+        if cache is None or cache.path != settings.doctree_cache:
+            cache = self.doctree_cache = DoctreeCache(
+                settings.doctree_cache,
+                settings.doctree_cache_size * 1024 * 1024)
+        document = cache.get(path, settings)
+        if document is None:
+            self.cache_source = path
+            self.deps_start = len(settings.record_dependencies.list)
+            return standalone.Reader.read(self, source, parser, settings)
+        self.source = source
+        self.settings = settings
+        if not self.parser:
+            self.parser = parser
+        document.settings = settings
+        document.reporter = docutils.utils.new_reporter(path, settings)
+        document.transformer = CachedTransformer(document)
+        self.document = document
+        return document
+
+    def store(self, document):
+        settings = document.settings
+        deps = settings.record_dependencies.list[self.deps_start:]
+        self.doctree_cache.put(self.cache_source, settings, document, deps)
+        self.cache_source = None
+
+
+def parse_pages(text):
+    """
+    Parse a ``--pages-to-output`` value into (first, last) pairs of
+    section numbers
+
+    >>> parse_pages('2,9-10,4.2-4.5')
+    [((2,), (2,)), ((9,), (10,)), ((4, 2), (4, 5))]
+    """
+    ranges = []
+    for item in text.split(','):
+        first, _, last = item.strip().partition('-')
+        first = tuple(int(num) for num in first.split('.'))
+        last = tuple(int(num) for num in last.split('.')) if last else first
+        ranges.append((first, last))
+    return ranges
+
+
+def validate_pages(setting, value, option_parser,
+                   config_parser=None, config_section=None):
+    try:
+        return parse_pages(value)
+    except ValueError:
+        raise ValueError('expected chapter or section numbers like '
+                         '"2,3,9-10" or "4.2-4.5", not "{0}"'.format(value))
+
+
+def validate_positive(setting, value, option_parser,
+                      config_parser=None, config_section=None):
+    value = int(value)
+    if value < 1:
+        raise ValueError('expected a positive number, not {0}'.format(value))
+    return value
+
+
+def validate_address(setting, value, option_parser,
+                     config_parser=None, config_section=None):
+    try:
+        return parse_address(value)
+    except ValueError:
+        raise ValueError('expected a port, HOST:PORT or the path of a Unix '
+                         'socket, not "{0}"'.format(value))
+
+
+def validate_template(setting, value, option_parser,
+                      config_parser=None, config_section=None):
+    try:
+        return get_template(value)
+    except (IOError, OSError) as e:
+        raise ValueError('can not read template: {0}'.format(e))
+
+
+def wants_section(ranges, number):
+    """
+    Is section ``number`` (eg. ``(4, 2)`` for the second section of the
+    fourth chapter) in ``ranges`` or does it contain a section that is
+
+    >>> ranges = parse_pages('2,4.2-4.3')
+    >>> [wants_section(ranges, n) for n in [(1,), (2,), (2, 7), (4,)]]
+    [False, True, True, True]
+    >>> [wants_section(ranges, n) for n in [(4, 1), (4, 3, 1), (5,)]]
+    [False, True, False]
+    """
+    return any(first[:len(number)] <= number[:len(first)] and
+               number[:len(last)] <= last
+               for first, last in ranges)
+
+
 class Writer(writers.Writer):
     settings_spec = (
         'NiTrile/LaTex Specific Options', # option group title
         None, # Description
         ( # options (help string, list of options, dictions of OptionParser.add_option dicts)
-            ('Specify a template (.otp) to use for styling',
+            ('Mapping of nodes to LaTeX: "memoir" (default), "nostarch" '
+             'or a JSON file of "tagname": [begin, end] pairs over a '
+             '"base" built-in one',
              ['--template-file'],
              {'action': 'store',
+              'validator': validate_template,
               'dest': 'template_file'}),
             ('Add title',
              ['--add-title'],
@@ -171,36 +387,1144 @@ class Writer(writers.Writer):
              ['--font'],
              {'action': 'store',
               'dest': 'font'}),
-            ('Specify pages to export (2,3,9-10)',
+            ('Only output these chapters or sections, eg. "2,3,9-10" or '
+             '"4.2-4.5" ("0" for the preamble and front matter only)',
              ['--pages-to-output'],
              {'action': 'store',
+              'validator': validate_pages,
               'dest': 'pages_to_output'}),
-            ('Specify a Pygments style (see pygmentize -L styles)',
+            ('Make tables with more rows than this longtables (40 default, '
+             '0 for only those after a ".. longtable:" comment)',
+             ['--longtable-rows'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 40,
+              'dest': 'longtable_rows'}),
+            ('Make tables with more characters (rows times source column '
+             'widths) than this longtables (4000 default, 0 to not check)',
+             ['--longtable-chars'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 4000,
+              'dest': 'longtable_chars'}),
+            ('Highlight code blocks with this Pygments style (see '
+             'pygmentize -L styles)',
              ['--pygments-style'],
              {'action': 'store',
               'dest': 'pygments_style'}),
+            ('LaTeX environment for literal and doctest blocks: '
+             '"lstlisting" (the default, "Code" for No Starch) or the '
+             'faster "verbatim"',
+             ['--listing-engine'],
+             {'type': 'choice',
+              'choices': ['lstlisting', 'verbatim'],
+              'default': 'lstlisting',
+              'dest': 'listing_engine'}),
+            ('Language of literal blocks that do not give one (with '
+             '--pygments-style, eg. "python")',
+             ['--pygments-language'],
+             {'action': 'store',
+              'dest': 'pygments_language'}),
+            ('Keep highlighted code blocks in this directory',
+             ['--pygments-cache'],
+             {'action': 'store',
+              'dest': 'pygments_cache'}),
+            ('Stream LaTeX to the destination while translating instead '
+             'of building the whole document in memory',
+             ['--stream-output'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'stream_output'}),
+            ('Bytes of streamed output to hold in memory before spilling '
+             'to a temporary file (8MB default)',
+             ['--stream-buffer-size'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 8 * 1024 * 1024,
+              'dest': 'stream_buffer_size'}),
+            ('Cache translated chapters in this directory and reuse '
+             'them when a chapter has not changed',
+             ['--chapter-cache'],
+             {'action': 'store',
+              'dest': 'chapter_cache'}),
+            ('Size limit for --chapter-cache in MB, least recently used '
+             'chapters are removed beyond it (256 default)',
+             ['--chapter-cache-size'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 256,
+              'dest': 'chapter_cache_size'}),
+            ('Translate chapters in this many worker processes (1 default)',
+             ['--jobs'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 1,
+              'dest': 'jobs'}),
+            ('Copy images on this many threads, 0 copies while '
+             'translating (4 default)',
+             ['--image-jobs'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 4,
+              'dest': 'image_jobs'}),
+            ('How to tell an image in the build directory is up to date: '
+             '"mtime" (size and mtime, default) or "hash" (contents)',
+             ['--image-check'],
+             {'type': 'choice',
+              'choices': ['mtime', 'hash'],
+              'default': 'mtime',
+              'dest': 'image_check'}),
+            ('Resample images to this resolution for their printed size '
+             '(needs Pillow, off by default)',
+             ['--image-dpi'],
+             {'action': 'store',
+              'type': 'int',
+              'dest': 'image_dpi'}),
+            ('Width of the text block in inches, used with --image-dpi '
+             '(4.5 default)',
+             ['--image-text-width'],
+             {'action': 'store',
+              'type': 'float',
+              'default': 4.5,
+              'dest': 'image_text_width'}),
+            ('Time the translation per node type and print a report to '
+             'stderr',
+             ['--profile-translate'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'profile_translate'}),
+            ('Also write the --profile-translate report to this file',
+             ['--profile-output'],
+             {'action': 'store',
+              'dest': 'profile_output'}),
+            ('Format for --profile-output: "json" (default) or '
+             '"collapsed" (flamegraph stacks)',
+             ['--profile-format'],
+             {'type': 'choice',
+              'choices': ['json', 'collapsed'],
+              'default': 'json',
+              'dest': 'profile_format'}),
+            ('Keep parsed doctrees in this directory and reuse them while '
+             'the source and the files it includes are unchanged',
+             ['--doctree-cache'],
+             {'action': 'store',
+              'dest': 'doctree_cache'}),
+            ('Size limit for --doctree-cache in MB, least recently used '
+             'doctrees are removed beyond it (256 default)',
+             ['--doctree-cache-size'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 256,
+              'dest': 'doctree_cache_size'}),
+            ('Run LaTeX (and makeindex) on the destination until the '
+             'cross references are stable',
+             ['--compile'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'compile'}),
+            ('LaTeX command for --compile ("pdflatex" default)',
+             ['--latex-command'],
+             {'action': 'store',
+              'default': 'pdflatex',
+              'dest': 'latex_command'}),
+            ('makeindex command for --compile ("makeindex" default)',
+             ['--makeindex-command'],
+             {'action': 'store',
+              'default': 'makeindex',
+              'dest': 'makeindex_command'}),
+            ('Most LaTeX passes for --compile (5 default)',
+             ['--latex-max-runs'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 5,
+              'dest': 'latex_max_runs'}),
+            ('Collect the index entries and write them sorted to '
+             '<destination>.ind for \\printindex, instead of \\index '
+             'commands for makeindex',
+             ['--write-index'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'write_index'}),
+            ('Move the preamble to <destination>-preamble.tex and, when '
+             'LaTeX is installed, precompile it with mylatexformat',
+             ['--preamble-format'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'preamble_format'}),
+            ('Write the files read and written, with their hashes and the '
+             'time taken per chapter, to this file',
+             ['--deps-file'],
+             {'action': 'store',
+              'dest': 'deps_file'}),
+            ('Format of --deps-file: "json" (default) or "make" (a .d '
+             'file of rules)',
+             ['--deps-format'],
+             {'action': 'store',
+              'type': 'choice',
+              'choices': ['json', 'make'],
+              'default': 'json',
+              'dest': 'deps_format'}),
+            ('Convert the "source destination" pairs listed in this file '
+             '(relative to it, "-" for stdin) with the other options',
+             ['--batch'],
+             {'action': 'store',
+              'dest': 'batch'}),
+            ('Convert --batch documents in this many processes (1 default)',
+             ['--batch-jobs'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 1,
+              'validator': validate_positive,
+              'dest': 'batch_jobs'}),
+            ('Rebuild whenever the source, a file it includes or an image '
+             'it uses changes, until interrupted',
+             ['--watch'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'watch'}),
+            ('Seconds between --watch checks (0.5 default)',
+             ['--watch-interval'],
+             {'action': 'store',
+              'type': 'float',
+              'default': 0.5,
+              'dest': 'watch_interval'}),
+            ('Convert the rst posted to this port, HOST:PORT or Unix '
+             'socket path with the other options, until interrupted',
+             ['--serve'],
+             {'action': 'store',
+              'validator': validate_address,
+              'dest': 'serve'}),
+            ('Worker processes for --serve (one per CPU default)',
+             ['--serve-jobs'],
+             {'action': 'store',
+              'type': 'int',
+              'validator': validate_positive,
+              'dest': 'serve_jobs'}),
+            ('Most waiting requests a --serve worker takes at once '
+             '(8 default)',
+             ['--serve-batch'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 8,
+              'validator': validate_positive,
+              'dest': 'serve_batch'}),
+            ('Waiting requests beyond which --serve answers 503 (64 '
+             'default)',
+             ['--serve-max-queue'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 64,
+              'validator': validate_positive,
+              'dest': 'serve_max_queue'}),
+            ('Seconds a --serve request may wait for its result before '
+             'it gets a 504 (60 default)',
+             ['--serve-timeout'],
+             {'action': 'store',
+              'type': 'int',
+              'default': 60,
+              'validator': validate_positive,
+              'dest': 'serve_timeout'}),
+            ('Let documents posted to --serve use raw LaTeX (raw '
+             'directives and roles), only for trusted clients',
+             ['--serve-allow-raw'],
+             {'action': 'store_true',
+              'default': False,
+              'dest': 'serve_allow_raw'}),
             )
         )
     def __init__(self):
         writers.Writer.__init__(self)
         self.translator_class = NitrileTranslator
+        # state kept between documents by long running callers (--watch)
+        self.chapter_cache = None
+        self.image_stager = None
+
+    def write(self, document, destination):
+        if not document.settings.stream_output:
+            output = writers.Writer.write(self, document, destination)
+        else:
+            self.document = document
+            self.destination = destination
+            self.translate()
+            head_filter = None
+            if document.settings.preamble_format:
+                head_filter = self.preamble_format().apply
+            self.visitor.doc.write_to(destination, head_filter)
+            output = None
+        if document.settings.write_index:
+            self.write_index()
+        if document.settings.compile:
+            self.compile()
+        if document.settings.deps_file:
+            self.write_deps()
+        return output
+
+    def write_deps(self):
+        settings = self.document.settings
+        visitor = self.visitor
+        manifest = BuildManifest()
+        if settings._source and settings._source != '-':
+            manifest.add_input('source', settings._source)
+        template = visitor.template.path
+        if template:
+            manifest.add_input('template', template)
+        # record_dependencies has the images and template too
+        listed = set(os.path.abspath(path) for path in
+                     list(visitor.staged_images.values()) + [template or ''])
+        for path in settings.record_dependencies.list:
+            if os.path.abspath(path) not in listed:
+                manifest.add_input('include', path)
+        for path in sorted(visitor.staged_images.values()):
+            manifest.add_input('image', path)
+        path = self.destination.destination_path
+        if path and path != '-':
+            base = os.path.splitext(path)[0]
+            manifest.add_output('tex', path)
+            if settings.preamble_format:
+                manifest.add_output('preamble', base + '-preamble.tex')
+            if settings.write_index:
+                manifest.add_output('index', base + '.ind')
+            if settings.compile:
+                manifest.add_output('pdf', base + '.pdf')
+        for path in sorted(visitor.staged_images):
+            manifest.add_output('image', path)
+        manifest.chapters = visitor.chapter_times
+        manifest.write(settings.deps_file, settings.deps_format)
+
+    def preamble_format(self):
+        path = self.destination.destination_path
+        if not path or path == '-':
+            raise SystemExit('--preamble-format needs a destination file')
+        return PreambleFormat(path, self.document.settings.latex_command)
+
+    def write_index(self):
+        path = self.destination.destination_path
+        if not path or path == '-':
+            raise SystemExit('--write-index needs a destination file')
+        self.visitor.index.write(os.path.splitext(path)[0] + '.ind')
+
+    def compile(self):
+        settings = self.document.settings
+        path = self.destination.destination_path
+        if not path or path == '-':
+            raise SystemExit('--compile needs a destination file')
+        makeindex = settings.makeindex_command
+        if settings.write_index:
+            makeindex = None  # the .ind is already written
+        compiler = LatexCompiler(path, settings.latex_command, makeindex,
+                                 settings.latex_max_runs)
+        try:
+            compiler.run()
+        except LatexError as e:
+            sys.stderr.write('{0}\n'.format(e))
+            raise SystemExit(1)
+
+    def report_profile(self, profile):
+        settings = self.document.settings
+        sys.stderr.write(profile.table())
+        if settings.profile_output:
+            profile.write(settings.profile_output, settings.profile_format)
 
     def translate(self):
-        if self.document.settings.no_chapters:
-            global DEFAULT_SECTION_IDX
-            DEFAULT_SECTION_IDX = 2
-        if self.document.settings.add_title:
-            global ADD_TITLE
-            ADD_TITLE = True
-
-        self.visitor = self.translator_class(self.document)
-        self.document.walkabout(self.visitor)
-        self.parts['whole'] = self.visitor.get_whole()
+        translator_class = self.translator_class
+        if self.document.settings.profile_translate:
+            translator_class = ProfilingTranslator
+        self.visitor = translator_class(self.document)
+        if self.visitor.highlighter and self.document.settings.jobs > 1:
+            self.visitor.highlighter.prefetch(self.visitor.code_blocks())
+        partial = self.visitor.pages is not None
+        if self.chapter_cache is not None and not partial:
+            self.visitor.chapter_cache = self.chapter_cache
+        stager = self.image_stager
+        if stager is None:
+            stager = ImageStager(self.document.settings.image_jobs,
+                                 self.document.settings.image_check)
+        self.visitor.image_stager = stager
+        jobs = self.document.settings.jobs
+        if jobs > 1:
+            import multiprocessing
+        if jobs > 1 and 'fork' not in multiprocessing.get_all_start_methods():
+            self.document.reporter.warning(
+                '--jobs needs fork(), translating chapters serially')
+            jobs = 1
+        if jobs > 1 and not partial:
+            self.visitor.chapter_pool = ChapterPool(self.visitor, jobs)
+        try:
+            self.document.walkabout(self.visitor)
+            if self.visitor.chapter_cache:
+                self.visitor.chapter_cache.prune()
+        finally:
+            if self.visitor.chapter_pool:
+                self.visitor.chapter_pool.close()
+                self.visitor.chapter_pool = None
+            start = _timer()
+            # a kept stager (--watch) keeps what it copied, but not its
+            # threads: the next build may fork a chapter pool
+            stager.close()
+            if self.document.settings.profile_translate:
+                self.visitor.profile.add_side_effect('image copy wait',
+                                                     _timer() - start)
+                self.report_profile(self.visitor.profile)
+        if self.document.settings.stream_output:
+            # body already went to the spool, Writer.write copies it out
+            self.parts['whole'] = None
+        else:
+            self.parts['whole'] = self.visitor.get_whole()
+            if self.document.settings.preamble_format:
+                self.parts['whole'] = self.preamble_format().apply(
+                    self.parts['whole'])
         self.output = self.parts['whole']
         self.parts['encoding'] = self.document.settings.output_encoding
         self.parts['version'] = docutils.__version__
 
 
+class ChunkPreamble(object):
+    """
+    Stand in for ``nt.Document.preamble`` that renders nodes (or takes
+    strings) as they are added
+    """
+    def __init__(self):
+        self.chunks = []
+
+    def __iadd__(self, node):
+        self.chunks.append(unicode(node))
+        return self
+
+    def __str__(self):
+        return ''.join(self.chunks)
+    __unicode__ = __str__
+
+
+class StreamingDocument(object):
+    """
+    Stand in for ``nt.Document`` that renders each node as soon as it
+    is added and sends the LaTeX to a spool file (kept in memory up to
+    ``max_size`` bytes, then on disk).
+
+    Chunks are gathered and written ``JOIN_CHUNKS`` at a time, except the
+    last, which ``doc -= ' '`` (footnote references) can still trim.
+    The preamble can grow at any point during the
+    walk (``latexpreamble`` raw nodes), so it is collected separately
+    and written ahead of the spooled body by ``write_to``.
+    """
+    BODY_MARKER = u'\x00rst2nitrile-body\x00'
+    BLOCK_SIZE = 64 * 1024
+    JOIN_CHUNKS = 4096
+
+    def __init__(self, max_size):
+        import tempfile
+        self.preamble = ChunkPreamble()
+        self.spool = tempfile.SpooledTemporaryFile(max_size=max_size,
+                                                   mode='w+',
+                                                   encoding='utf-8')
+        self._doc = nt.Document()  # images and final layout
+        self.chunks = []
+
+    def add_image(self, uri, path):
+        self._doc.add_image(uri, path)
+
+    def write(self, txt):
+        chunks = self.chunks
+        chunks.append(txt)
+        if len(chunks) >= self.JOIN_CHUNKS:
+            self.spool.write(u''.join(chunks[:-1]))
+            del chunks[:-1]
+
+    def __iadd__(self, node):
+        self.write(unicode(node))
+        return self
+
+    def __isub__(self, txt):
+        if self.chunks and self.chunks[-1].endswith(txt):
+            self.chunks[-1] = self.chunks[-1][:-len(txt)]
+        return self
+
+    def close(self):
+        if self.chunks:
+            self.spool.write(u''.join(self.chunks))
+            del self.chunks[:]
+
+    def frame(self):
+        """
+        Return the (head, tail) text nitrile puts around the body
+        """
+        self._doc.preamble += nt.Raw(unicode(self.preamble), escape=False)
+        self._doc += nt.Raw(self.BODY_MARKER, escape=False)
+        head, tail = unicode(self._doc).split(self.BODY_MARKER)
+        return head, tail
+
+    def copy_body(self, out):
+        self.spool.seek(0)
+        while True:
+            block = self.spool.read(self.BLOCK_SIZE)
+            if not block:
+                break
+            out.write(block)
+
+    def write_to(self, destination, head_filter=None):
+        """
+        Write preamble, spooled body and ending to a docutils
+        ``Output`` without joining them in memory
+        """
+        self.close()
+        head, tail = self.frame()
+        if head_filter:
+            head = head_filter(head)
+        autoclose = destination.autoclose
+        destination.autoclose = False
+        try:
+            destination.write(head)
+            self.copy_body(destination)
+            destination.write(tail)
+        finally:
+            destination.autoclose = autoclose
+            self.spool.close()
+        if autoclose:
+            destination.close()
+
+
+class FragmentDocument(object):
+    """
+    Stand in for ``nt.Document`` that captures the LaTeX of one part
+    of the tree (body and preamble additions) so it can be cached and
+    replayed into another document.  The translator keeps track of
+    the images (``chapter_images``).
+
+    The body is kept as strings, every ``JOIN_CHUNKS`` of them joined
+    into a block except the last, which ``doc -= ' '`` (footnote
+    references) can still trim.
+    """
+    JOIN_CHUNKS = 4096
+
+    def __init__(self):
+        self.preamble = ChunkPreamble()
+        self.blocks = []
+        self.chunks = []
+
+    def add_image(self, uri, path):
+        pass
+
+    def write(self, txt):
+        chunks = self.chunks
+        chunks.append(txt)
+        if len(chunks) >= self.JOIN_CHUNKS:
+            self.blocks.append(''.join(chunks[:-1]))
+            del chunks[:-1]
+
+    def __iadd__(self, node):
+        self.write(unicode(node))
+        return self
+
+    def __isub__(self, txt):
+        if self.chunks and self.chunks[-1].endswith(txt):
+            self.chunks[-1] = self.chunks[-1][:-len(txt)]
+        return self
+
+    def body(self):
+        return ''.join(self.blocks + self.chunks)
+
+
+class BufferDocument(FragmentDocument):
+    """
+    Stand in for ``nt.Document`` holding the whole body as a
+    FragmentDocument does, rather than an ``nt.Raw`` per fragment.
+    nitrile only lays out the preamble and images around a marker when
+    the document is rendered, and the body goes in with a single join.
+    """
+    BODY_MARKER = StreamingDocument.BODY_MARKER
+
+    def __init__(self):
+        FragmentDocument.__init__(self)
+        self.images = []
+
+    def add_image(self, uri, path):
+        self.images.append((uri, path))
+
+    def __str__(self):
+        doc = nt.Document()
+        for uri, path in self.images:
+            doc.add_image(uri, path)
+        doc.preamble += nt.Raw(unicode(self.preamble), escape=False)
+        doc += nt.Raw(self.BODY_MARKER, escape=False)
+        head, tail = unicode(doc).split(self.BODY_MARKER)
+        return ''.join([head] + self.blocks + self.chunks + [tail])
+    __unicode__ = __str__
+
+
+def _code_fingerprint():
+    # cached output is only valid for the translator that made it
+    with open(os.path.abspath(__file__).replace('.pyc', '.py'), 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+class ChapterCache(object):
+    """
+    On-disk cache of translated chapters, one pickle per content hash.
+    ``prune`` removes the chapters not used recently once the directory
+    grows beyond ``max_size`` bytes.
+    """
+    VERSION = 1
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        self.fingerprint = _code_fingerprint()
+
+    def key(self, *parts):
+        h = hashlib.sha1()
+        h.update(repr((self.VERSION, self.fingerprint,
+                       getattr(nt, '__version__', None))).encode('utf-8'))
+        for part in parts:
+            h.update(unicode(part).encode('utf-8'))
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.path, key + '.pickle')
+
+    def get(self, key):
+        import pickle
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as fin:
+                entry = pickle.load(fin)
+            os.utime(filename, None)  # recently used
+        except (IOError, OSError, EOFError, pickle.UnpicklingError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        import pickle
+        filename = self._filename(key)
+        tmp = _tmp_path(filename)
+        with open(tmp, 'wb') as fout:
+            pickle.dump(entry, fout, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp, filename)
+
+    def __contains__(self, key):
+        return os.path.exists(self._filename(key))
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.pickle'):
+                try:
+                    st = os.stat(os.path.join(self.path, name))
+                except OSError:  # pruned by another build (--batch-jobs)
+                    continue
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            total -= size
+
+
+class MemoryChapterCache(ChapterCache):
+    """
+    ChapterCache kept in memory, ``prune`` drops the entries the last
+    build did not use
+    """
+    def __init__(self):
+        self.entries = {}
+        self.used = set()
+        self.fingerprint = _code_fingerprint()
+
+    def get(self, key):
+        entry = self.entries.get(key)
+        if entry is not None:
+            self.used.add(key)
+        return entry
+
+    def put(self, key, entry):
+        self.entries[key] = entry
+        self.used.add(key)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    def prune(self):
+        self.entries = dict((key, self.entries[key]) for key in self.used)
+        self.used = set()
+
+
+def _tmp_path(path, suffix=''):
+    # unique to this process and thread, renamed over ``path`` once written
+    return '{0}.{1}-{2}.tmp{3}'.format(path, os.getpid(),
+                                       threading.current_thread().ident,
+                                       suffix)
+
+
+def _file_stamp(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return None
+    return (st.st_mtime, st.st_size)
+
+
+def _file_hash(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fin:
+        for block in iter(lambda: fin.read(64 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+# settings that change the doctree docutils builds
+DOCTREE_SETTINGS = (
+    'input_encoding', 'tab_width', 'file_insertion_enabled', 'raw_enabled',
+    'line_length_limit', 'language_code', 'report_level', 'id_prefix',
+    'auto_id_prefix', 'doctitle_xform', 'docinfo_xform',
+    'sectsubtitle_xform', 'sectnum_xform', 'toc_backlinks',
+    'footnote_backlinks', 'trim_footnote_reference_space', 'pep_references',
+    'rfc_references', 'smart_quotes', 'syntax_highlight',
+    'character_level_inline_markup', 'strip_comments',
+    'strip_elements_with_classes', 'strip_classes', 'expose_internals')
+
+
+_DoctreeUnpickler = None  # made by _doctree_unpickler()
+
+
+def _doctree_unpickler(fin):
+    global _DoctreeUnpickler
+    if _DoctreeUnpickler is None:
+        import pickle
+
+        class _DoctreeUnpickler(pickle.Unpickler):
+            # the ``index`` and ``envvar`` nodes are pickled as
+            # ``__main__.index`` when run as a script and
+            # ``rst2nitrile.index`` when imported, find them in this
+            # module either way
+            def find_class(self, module, name):
+                if module in ('__main__', 'rst2nitrile'):
+                    return getattr(sys.modules[__name__], name)
+                return pickle.Unpickler.find_class(self, module, name)
+    return _DoctreeUnpickler(fin)
+
+
+class DoctreeCache(object):
+    """
+    On-disk cache of transformed doctrees, one file per source.  A file
+    holds the dependencies (source, includes) with their stamps and
+    hashes, then the pickled doctree.  Files not used recently are
+    removed once the directory grows beyond ``max_size`` bytes.
+    """
+    VERSION = 1
+
+    def __init__(self, path, max_size=256 * 1024 * 1024):
+        self.path = path
+        self.max_size = max_size
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
+        self.fingerprint = _code_fingerprint()
+
+    def filename(self, source, settings):
+        h = hashlib.sha1()
+        h.update(repr((self.VERSION, self.fingerprint, docutils.__version__,
+                       sys.version_info[:2], os.path.abspath(source),
+                       [getattr(settings, name, None)
+                        for name in DOCTREE_SETTINGS])).encode('utf-8'))
+        return os.path.join(self.path, h.hexdigest() + '.doctree')
+
+    def get(self, source, settings):
+        """
+        Return the cached doctree for ``source``, None when missing or
+        out of date.  Its dependencies are added to
+        ``settings.record_dependencies``.
+        """
+        import pickle
+        filename = self.filename(source, settings)
+        try:
+            with open(filename, 'rb') as fin:
+                deps = _doctree_unpickler(fin).load()
+                for _, path, stamp, digest in deps:
+                    if _file_stamp(path) != stamp and (
+                            not os.path.exists(path) or
+                            _file_hash(path) != digest):
+                        return None
+                # the cyclic GC would run over and over while a large
+                # tree is rebuilt, without freeing anything
+                gc_enabled = gc.isenabled()
+                gc.disable()
+                try:
+                    document = _doctree_unpickler(fin).load()
+                finally:
+                    if gc_enabled:
+                        gc.enable()
+        except (IOError, OSError, EOFError, AttributeError, ImportError,
+                pickle.UnpicklingError):
+            return None
+        os.utime(filename, None)  # recently used
+        for path, _, _, _ in deps[1:]:
+            settings.record_dependencies.add(path)
+        return document
+
+    def put(self, source, settings, document, dep_paths):
+        import pickle
+        # as recorded, absolute for checking
+        deps = [(path, os.path.abspath(path), _file_stamp(path),
+                 _file_hash(path))
+                for path in [source] + list(dep_paths)
+                if os.path.isfile(path)]
+        # the settings, reporter (streams) and transformer (components)
+        # belong to this run
+        saved = document.settings, document.reporter, document.transformer
+        document.settings = document.reporter = document.transformer = None
+        filename = self.filename(source, settings)
+        tmp = _tmp_path(filename)
+        try:
+            with open(tmp, 'wb') as fout:
+                pickle.dump(deps, fout, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(document, fout, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, filename)
+        except (pickle.PicklingError, AttributeError, TypeError,
+                RuntimeError) as e:
+            # eg. a directive left something unpicklable in the tree
+            sys.stderr.write('Not caching doctree for {0}: {1}\n'.format(
+                source, e))
+            os.remove(tmp)
+        finally:
+            (document.settings, document.reporter,
+             document.transformer) = saved
+        self.prune()
+
+    def prune(self):
+        entries = []
+        for name in os.listdir(self.path):
+            if name.endswith('.doctree'):
+                st = os.stat(os.path.join(self.path, name))
+                entries.append((st.st_mtime, st.st_size, name))
+        total = sum(size for _, size, _ in entries)
+        for _, size, name in sorted(entries):
+            if total <= self.max_size:
+                break
+            os.remove(os.path.join(self.path, name))
+            total -= size
+
+
+RESAMPLE_DIR = 'rst2nitrile-images'
+
+
+def resample_image(full_path, out_path, width, scale, dpi):
+    """
+    Write a copy of ``full_path`` resampled to ``dpi`` at its printed
+    size: ``width`` inches, or ``scale`` times its natural size.
+    Images are never upscaled.  The stored resolution is adjusted so
+    ``scale=`` still gives the same printed size.
+    """
+    img = Image.open(full_path)
+    img_dpi = img.info.get('dpi', (72, 72))[0] or 72
+    if width:
+        pixels = int(math.ceil(width * dpi))
+    else:
+        pixels = int(math.ceil(img.size[0] * scale * dpi / img_dpi))
+    tmp = _tmp_path(out_path, os.path.splitext(out_path)[1])
+    if pixels >= img.size[0]:
+        shutil.copy(full_path, tmp)
+    else:
+        factor = float(pixels) / img.size[0]
+        height = max(1, int(round(img.size[1] * factor)))
+        small = img.resize((pixels, height), Image.LANCZOS)
+        options = {'dpi': (img_dpi * factor, img_dpi * factor),
+                   'optimize': True}
+        if img.format == 'JPEG':
+            options['quality'] = 85
+        small.save(tmp, img.format, **options)
+    os.rename(tmp, out_path)
+
+
+class ImageStager(object):
+    """
+    Copies images into the build directory, or resamples them into
+    ``RESAMPLE_DIR`` there (see ``resample_image``).
+
+    A copy is skipped when the build copy is already up to date: the
+    same size and not older than the source, or with ``check='hash'``
+    the same contents.  Copies run on a thread pool of ``jobs`` threads
+    while translation continues (``jobs=0`` copies right away);
+    ``wait`` blocks until they are done and re-raises the first error,
+    ``close`` also stops the threads (the next ``stage`` starts them
+    again).
+    """
+    def __init__(self, jobs=4, check='mtime'):
+        self.check = check
+        self.copies = {}  # build path -> (source path, source stamp)
+        self.resamples = {}  # build path -> resample arguments
+        self.pending = []
+        self.jobs = jobs
+        self.pool = None  # started by the first stage()
+
+    def stage(self, full_path, out_path, resample=None):
+        if resample:
+            self.resamples[out_path] = resample
+        if self.jobs <= 0:
+            self.copy(full_path, out_path)
+        else:
+            if self.pool is None:
+                import multiprocessing.pool
+                self.pool = multiprocessing.pool.ThreadPool(self.jobs)
+            self.pending.append(
+                self.pool.apply_async(self.copy, (full_path, out_path)))
+
+    def up_to_date(self, full_path, out_path, stamp):
+        out_stamp = _file_stamp(out_path)
+        if stamp is None or out_stamp is None:
+            return False
+        if out_path in self.resamples:
+            # resampled images are redone when the source is newer
+            return out_stamp[0] >= stamp[0]
+        if out_stamp[1] != stamp[1]:
+            return False
+        if self.check == 'hash':
+            return _file_hash(full_path) == _file_hash(out_path)
+        return out_stamp[0] >= stamp[0]
+
+    def copy(self, full_path, out_path):
+        """
+        Copy ``full_path`` to ``out_path`` unless it is up to date,
+        return True if it copied
+        """
+        stamp = _file_stamp(full_path)
+        if (self.copies.get(out_path) == (full_path, stamp)
+                and os.path.exists(out_path)):
+            return False
+        copied = False
+        if not self.up_to_date(full_path, out_path, stamp):
+            try:
+                os.makedirs(os.path.dirname(out_path))
+            except OSError as e:
+                if "File exists" in str(e):
+                    pass
+                else:
+                    raise
+            try:
+                if out_path in self.resamples:
+                    resample_image(full_path, out_path,
+                                   *self.resamples[out_path])
+                else:
+                    shutil.copy(full_path, out_path)
+                copied = True
+            except shutil.Error as e:
+                if 'same file' in str(e):
+                    pass
+                else:
+                    raise
+        self.copies[out_path] = (full_path, stamp)
+        return copied
+
+    def wait(self):
+        pending, self.pending = self.pending, []
+        for result in pending:
+            result.get()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+                self.pool = None
+
+
+def _highlight(job):
+    """
+    Pygments LaTeX for a (code, language, style) job, None when there
+    is no lexer for the language
+    """
+    code, language, style = job
+    load_pygments()  # for workers that didn't fork from a translator
+    try:
+        lexer = get_lexer_by_name(language)
+    except ClassNotFound:
+        return None
+    return pygments.highlight(code, lexer, LatexFormatter(style=style))
+
+
+class Highlighter(object):
+    """
+    Highlight code blocks with Pygments' LaTeX formatter.  Results are
+    kept in memory and, with a ``cache_dir``, on disk keyed by the hash
+    of code, language, style and Pygments version.  ``prefetch``
+    highlights the blocks not in the cache in ``jobs`` processes
+    before the walk.
+    """
+    def __init__(self, style, cache_dir=None, jobs=1):
+        self.style = style
+        self.cache_dir = cache_dir
+        self.jobs = jobs
+        self.results = {}  # key -> LaTeX (None when not highlighted)
+        if cache_dir:
+            try:
+                os.makedirs(cache_dir)
+            except OSError:
+                if not os.path.isdir(cache_dir):
+                    raise
+
+    def style_defs(self):
+        return LatexFormatter(style=self.style).get_style_defs()
+
+    def key(self, code, language):
+        h = hashlib.sha1()
+        h.update(repr((pygments.__version__, self.style,
+                       language)).encode('utf-8'))
+        h.update(code.encode('utf-8'))
+        return h.hexdigest()
+
+    def _filename(self, key):
+        return os.path.join(self.cache_dir, key + '.tex')
+
+    def cached(self, key):
+        if key in self.results:
+            return True
+        if not self.cache_dir:
+            return False
+        try:
+            with io_open(self._filename(key), encoding='utf-8') as fin:
+                self.results[key] = fin.read()
+        except (IOError, OSError):
+            return False
+        return True
+
+    def store(self, key, latex):
+        self.results[key] = latex
+        if self.cache_dir and latex is not None:
+            filename = self._filename(key)
+            tmp = _tmp_path(filename)
+            with io_open(tmp, 'w', encoding='utf-8') as fout:
+                fout.write(latex)
+            os.rename(tmp, filename)
+
+    def prefetch(self, blocks):
+        """
+        Highlight the (code, language) ``blocks`` missing from the cache
+        """
+        missing = {}
+        for code, language in blocks:
+            key = self.key(code, language)
+            if key not in missing and not self.cached(key):
+                missing[key] = (code, language, self.style)
+        if not missing:
+            return
+        keys = list(missing)
+        jobs = [missing[key] for key in keys]
+        if self.jobs > 1 and len(jobs) > 1:
+            import multiprocessing
+            pool = multiprocessing.Pool(min(self.jobs, len(jobs)))
+            try:
+                results = pool.map(_highlight, jobs,
+                                   chunksize=max(1, len(jobs) // (self.jobs * 4)))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            results = [_highlight(job) for job in jobs]
+        for key, latex in zip(keys, results):
+            self.store(key, latex)
+
+    def highlight(self, code, language):
+        key = self.key(code, language)
+        if not self.cached(key):
+            self.store(key, _highlight((code, language, self.style)))
+        return self.results[key]
+
+
+def _findall(node, condition):
+    # Node.traverse is obsoleted by findall in newer docutils
+    if hasattr(node, 'findall'):
+        return node.findall(condition)
+    return node.traverse(condition)
+
+
+# (translator class, document, Template, Highlighter) inherited by forked
+# pool workers
+_POOL_JOB = None
+
+
+def _translate_chapter(idx, state):
+    translator_class, document, mapping, highlighter = _POOL_JOB
+    visitor = translator_class(document, mapping)
+    if highlighter is not None:
+        # with the blocks the parent prefetched
+        visitor.highlighter = highlighter
+    visitor.chapter_cache = None
+    visitor.copy_images = False
+    visitor.set_chapter_state(state)
+    visitor.doc = FragmentDocument()
+    document[idx].walkabout(visitor)
+    return visitor.chapter_entry(visitor.doc)
+
+
+class ChapterPool(object):
+    """
+    Translate the top level sections of a document in forked worker
+    processes.
+
+    Workers inherit the parsed document (the ``index-N`` ids are fixed
+    while parsing) and the translator's settings.  Each chapter starts
+    from a predicted ``chapter_state`` (``saw_title`` and pending
+    longtable settings); if the serial walk reaches the chapter in a
+    different state the worker's result is dropped and the chapter is
+    translated in process, so the output matches a serial run.
+    Images are copied by the main process.
+    """
+    def __init__(self, translator, jobs):
+        global _POOL_JOB
+        _POOL_JOB = (translator.__class__, translator.document,
+                     translator.template, translator.highlighter)
+        import multiprocessing
+        self.pool = multiprocessing.get_context('fork').Pool(jobs)
+        self.results = {}
+        cache = translator.chapter_cache
+        state = translator.chapter_state()
+        saw_title = state['saw_title']
+        for idx, node in enumerate(translator.document.children):
+            if not isinstance(node, nodes.section):
+                if not saw_title:
+                    saw_title = any(True for _ in _findall(node, nodes.title))
+                continue
+            predicted = dict(state, saw_title=saw_title)
+            saw_title = True
+            if cache and translator.chapter_key(node, predicted) in cache:
+                continue
+            self.results[id(node)] = (
+                predicted,
+                self.pool.apply_async(_translate_chapter, (idx, predicted)))
+
+    def result(self, node, state):
+        """
+        Return the cache style entry for ``node`` or None if it was not
+        translated from ``state``
+        """
+        predicted, result = self.results.pop(id(node), (None, None))
+        if result is None or predicted != state:
+            return None
+        return result.get()
+
+    def close(self):
+        global _POOL_JOB
+        if self.results:
+            # chapters the walk never used (error or state mismatch)
+            self.pool.terminate()
+        else:
+            self.pool.close()
+        self.pool.join()
+        _POOL_JOB = None
+
+
 MEMOIR_MAPPING = {
     'literal': (r'\texttt{', '}'),
     'strong': (r'\textbf{', '}'),
@@ -281,77 +1605,602 @@ MEMOIR_MAPPING = {
     
 }
 
-NOSTARCH_MAPPING = MEMOIR_MAPPING.copy()
-NOSTARCH_MAPPING.update({
-    'table':('\\begin{table}\n\\tbfont\n\\begin{tabulary}{\\textwidth}',
-             '\\end{tabulary}\\end{table}\n'),
-    'literal': (r'\lstinline{', '}'),
-    'note': (r'\begin{note}', '\n\\end{note}\n'),
-    'tip': (r'\begin{note}', '\n\\end{note}\n'),
-    'hint': (r'\begin{note}', '\n\\end{note}\n'),
-    'doctest_block':('\\begin{Code}\n',
-                     '\n\\end{Code}\n\n'),
-    # get rid of lines above/below code
-    'literal_block':('\\begin{Code}[frame=none,framerule=0.25pt]\n',
-                     '\n\\end{Code}\n\n'),
-    })
+NOSTARCH_MAPPING = MEMOIR_MAPPING.copy()
+NOSTARCH_MAPPING.update({
+    'table':('\\begin{table}\n\\tbfont\n\\begin{tabulary}{\\textwidth}',
+             '\\end{tabulary}\\end{table}\n'),
+    'literal': (r'\lstinline{', '}'),
+    'note': (r'\begin{note}', '\n\\end{note}\n'),
+    'tip': (r'\begin{note}', '\n\\end{note}\n'),
+    'hint': (r'\begin{note}', '\n\\end{note}\n'),
+    'doctest_block':('\\begin{Code}\n',
+                     '\n\\end{Code}\n\n'),
+    # get rid of lines above/below code
+    'literal_block':('\\begin{Code}[frame=none,framerule=0.25pt]\n',
+                     '\n\\end{Code}\n\n'),
+    })
+
+# --template-file names of the built-in mappings
+BUILTIN_MAPPINGS = {'memoir': MEMOIR_MAPPING, 'nostarch': NOSTARCH_MAPPING}
+
+# mapping keys that are not tags, their end has a ``{}`` for the caption
+TABLE_CODES = ('table_code', 'long_table_code', 'table_code_old')
+
+
+def split_closer(end):
+    """
+    Split the end of a table code around its ``{}`` caption field,
+    undoubling the braces
+
+    >>> split_closer('\\\\end{{tabulary}}{}\\\\end{{figure}}\\n')
+    ('\\\\end{tabulary}', '\\\\end{figure}\\n')
+    """
+    parts = list(string.Formatter().parse(end))
+    fields = [(name, spec, conversion)
+              for _, name, spec, conversion in parts if name is not None]
+    if fields != [('', '', None)]:
+        raise ValueError('needs exactly one "{{}}" for the caption (other '
+                         'braces doubled), not {0!r}'.format(end))
+    before, after = [], []
+    out = before
+    for literal, name, _, _ in parts:
+        out.append(literal)
+        if name is not None:
+            out = after
+    return ''.join(before), ''.join(after)
+
+
+class Template(object):
+    """
+    A node mapping checked and compiled for the translator: the
+    (begin, end) pair of each tag and the table environments as
+    (begin, end before the caption, end after it), the end after being
+    None for environments without a caption (No Starch's ``table``).
+    ``path`` is the JSON file it came from.
+    """
+    def __init__(self, mapping, path=None):
+        self.path = path
+        where = path or 'mapping'
+        known = set(nodes.node_class_names) | set(TABLE_CODES)
+        known.update(attr[len('visit_'):] for attr in dir(NitrileTranslator)
+                     if attr.startswith('visit_'))
+        known.discard('Text')
+        for name, pair in mapping.items():
+            if name not in known:
+                raise ValueError('{0}: unknown node "{1}"'.format(where, name))
+            if (not isinstance(pair, (list, tuple)) or len(pair) != 2 or
+                    not all(part is None or isinstance(part, (str, unicode))
+                            for part in pair)):
+                raise ValueError('{0}: "{1}" should be a [begin, end] pair '
+                                 'of strings or nulls'.format(where, name))
+        self.mapping = dict((name, tuple(pair))
+                            for name, pair in mapping.items())
+        codes = {}
+        for name in TABLE_CODES[:2]:
+            begin, end = self.mapping.get(name, (None, None))
+            if begin is None or end is None:
+                raise ValueError('{0}: "{1}" needs a begin and an '
+                                 'end'.format(where, name))
+            try:
+                codes[name] = (begin,) + split_closer(end)
+            except ValueError as e:
+                raise ValueError('{0}: end of "{1}" {2}'.format(where, name,
+                                                                e))
+        self.long_table_code = codes['long_table_code']
+        if self.mapping.get('table', (None, None))[0] is not None:
+            # No Starch has its own table environment, without caption
+            self.table_code = self.mapping['table'] + (None,)
+        else:
+            self.table_code = codes['table_code']
+
+
+def load_template(path):
+    """
+    Read a --template-file: a JSON object of ``"tagname": [begin,
+    end]`` pairs over the ``"base"`` built-in mapping ("memoir" unless
+    given).  A null pair drops the tag from the base.
+    """
+    import json
+    with io_open(path, encoding='utf-8') as fin:
+        try:
+            data = json.load(fin)
+        except ValueError as e:
+            raise ValueError('{0}: {1}'.format(path, e))
+    if not isinstance(data, dict):
+        raise ValueError('{0}: expected an object of "tagname": [begin, '
+                         'end] pairs'.format(path))
+    base = data.pop('base', 'memoir')
+    if base not in BUILTIN_MAPPINGS:
+        raise ValueError('{0}: "base" should be one of {1}'.format(
+            path, ', '.join(sorted(BUILTIN_MAPPINGS))))
+    mapping = dict(BUILTIN_MAPPINGS[base])
+    for name, pair in data.items():
+        if pair is None:
+            mapping.pop(name, None)
+        else:
+            mapping[name] = pair
+    return Template(mapping, path)
+
+
+# compiled built-in templates by name, and template files by absolute
+# path with the stamp they were read at
+_TEMPLATES = {}
+
+
+def get_template(value=None):
+    """
+    The Template for a --template-file value: None (memoir), a built-in
+    name, the path of a JSON file (read again only when it changes), a
+    mapping or a Template
+    """
+    if isinstance(value, Template):
+        if value.path is None:
+            return value
+        value = value.path
+    if value is None:
+        value = 'memoir'
+    if isinstance(value, dict):
+        return Template(value)
+    if value in BUILTIN_MAPPINGS:
+        template = _TEMPLATES.get(value)
+        if template is None:
+            template = _TEMPLATES[value] = Template(BUILTIN_MAPPINGS[value])
+        return template
+    key = os.path.abspath(value)
+    stamp = _file_stamp(key)
+    if stamp is None:
+        raise ValueError('no template file {0}'.format(value))
+    cached = _TEMPLATES.get(key)
+    if cached is None or cached[0] != stamp:
+        cached = _TEMPLATES[key] = (stamp, load_template(value))
+    return cached[1]
+
+
+_INDEX_ESCAPES = {
+    '!': '"!',
+    '#': r'"\#',
+    '%': r'\%',
+    '_': r'\_',
+    '{': r'\{',
+    '}': r'\}',
+    '@': '"@',
+    '&': r'\&',
+    '^ ': r'\textasciicircum{}\enspace',
+    '^': r'\textasciicircum{}',
+    '~': r'\textasciitilde{}',
+}
+_INDEX_RE = re.compile(r'\^ |[!#%_{}@&^~]')
+
+
+def _index_sub(match):
+    return _INDEX_ESCAPES[match.group()]
+
+# short strings (index terms, inline literals) repeat a lot
+_MEMO_LEN = 80
+_MEMO_SIZE = 10000
+_INDEX_MEMO = {}
+_ESCAPE_MEMO = {}
+
+
+def _memoized(memo, func, txt):
+    if len(txt) > _MEMO_LEN:
+        return func(txt)
+    try:
+        return memo[txt]
+    except KeyError:
+        if len(memo) >= _MEMO_SIZE:
+            memo.clear()
+        result = memo[txt] = func(txt)
+        return result
+
+
+def _index_escape(txt):
+    if not _INDEX_RE.search(txt):
+        return txt
+    return _INDEX_RE.sub(_index_sub, txt)
+
+
+def index_escape(txt):
+    """
+    Escape ``txt`` for ``\\index{}``, quoting makeindex's ``!`` and
+    ``@`` so they don't split or sort the entry
+
+    >>> print(index_escape('a_b!c@d ^ e'))
+    a\\_b"!c"@d \\textasciicircum{}\\enspacee
+    """
+    return _memoized(_INDEX_MEMO, _index_escape, txt)
+
+
+def parse_index_entry(text):
+    """
+    Read the text of an ``\\index{}`` the way makeindex does: ``!``
+    separates levels, ``@`` the sort key from the printed text and
+    ``|`` the page format, ``"`` quotes the next character.  Return
+    the levels as (sort key, printed) pairs and the page format
+
+    >>> parse_index_entry('a"!b@\\emph{a"!b}!c|textbf')
+    ([('a!b', '\\\\emph{a!b}'), ('c', 'c')], 'textbf')
+    """
+    levels = []
+    parts = [[]]  # sort key, then printed text after an @
+    idx = 0
+    while idx < len(text):
+        char = text[idx]
+        if char in '"\\' and idx + 1 < len(text):
+            # a quote is dropped, an escape kept (\" stays \")
+            parts[-1].append(text[idx + 1] if char == '"'
+                             else text[idx:idx + 2])
+            idx += 2
+            continue
+        if char == '!':
+            levels.append(parts)
+            parts = [[]]
+        elif char == '@' and len(parts) == 1:
+            parts.append([])
+        elif char == '|':
+            break
+        else:
+            parts[-1].append(char)
+        idx += 1
+    levels.append(parts)
+    encap = text[idx + 1:].lstrip('()')
+    pairs = []
+    for parts in levels:
+        key = ''.join(parts[0]).strip()
+        pairs.append((key, ''.join(parts[-1]).strip()))
+    return pairs, encap
+
+
+def _index_sort_key(key):
+    # makeindex's order: symbols, numbers, then letters ignoring case
+    first = key[:1]
+    if first.isalpha():
+        return (2, key.lower(), key)
+    if key.isdigit():
+        return (1, int(key), key)
+    return (0, key.lower(), key)
+
+
+class LatexIndex(object):
+    """
+    Index entries collected while translating (``--write-index``),
+    written as a sorted and grouped .ind in makeindex's default style
+    so ``\\printindex`` needs no makeindex run.  Entries are the text
+    ``\\index{}`` would get (see ``parse_index_entry``) and pages are
+    ``\\pageref`` s to the ``\\label`` at each index directive, so an
+    entry used twice on a page lists the page twice.
+    """
+    LEVELS = ['\\item ', '\\subitem ', '\\subsubitem ']
+
+    def __init__(self):
+        self.entries = []  # (text, label, main) in document order
+
+    def add(self, text, label, main=False):
+        self.entries.append((text, label, main))
+
+    def tree(self):
+        root = {}  # (sort key, printed) -> [pages, children]
+        for text, label, main in self.entries:
+            levels, encap = parse_index_entry(text)
+            if main and not encap:
+                encap = 'textbf'
+            children = root
+            for level in levels[:len(self.LEVELS)]:
+                item = children.setdefault(level, [[], {}])
+                children = item[1]
+            if (label, encap) not in item[0]:
+                item[0].append((label, encap))
+        return root
+
+    def render(self):
+        lines = ['\\begin{theindex}\n']
+        group = None
+        for (key, printed), item in sorted(
+                self.tree().items(), key=lambda kv: _index_sort_key(kv[0][0])):
+            sort_key = _index_sort_key(key)
+            new_group = sort_key[0] if sort_key[0] < 2 else key[:1].lower()
+            if group is not None and new_group != group:
+                lines.append('\n  \\indexspace\n')
+            group = new_group
+            self.render_item(lines, printed, item, 0)
+        lines.append('\n\\end{theindex}\n')
+        return '\n'.join(lines)
+
+    def render_item(self, lines, printed, item, depth):
+        pages, children = item
+        refs = []
+        for label, encap in pages:
+            ref = '\\pageref{{{0}}}'.format(label)
+            refs.append('\\{0}{{{1}}}'.format(encap, ref) if encap else ref)
+        line = '  ' * (depth + 1) + self.LEVELS[depth] + printed
+        if refs:
+            line += ', ' + ', '.join(refs)
+        lines.append(line)
+        for (key, child_printed), child in sorted(
+                children.items(), key=lambda kv: _index_sort_key(kv[0][0])):
+            self.render_item(lines, child_printed, child, depth + 1)
+
+    def write(self, path):
+        with io_open(path, 'w', encoding='utf-8') as fout:
+            fout.write(self.render())
+
+
+_SAFE_RE = None  # text nitrile's escaping leaves alone, see _safe_re
+
+
+def _safe_re():
+    # only letters, digits and simple spacing, each checked against
+    # nitrile so the fast path can't change the output
+    global _SAFE_RE
+    if _SAFE_RE is None:
+        candidates = string.ascii_letters + string.digits + ' ,\n'
+        safe = [c for c in candidates
+                if unicode(nt.Raw(c, escape=True)) == c]
+        _SAFE_RE = re.compile('[{0}]*\\Z'.format(re.escape(''.join(safe))))
+    return _SAFE_RE
+
+
+def _latex_escape(txt):
+    if _safe_re().match(txt):
+        return txt
+    return unicode(nt.Raw(txt, escape=True))
+
+
+def latex_escape(txt):
+    """
+    Return ``txt`` as ``nt.Raw(txt, escape=True)`` renders it
+    """
+    return _memoized(_ESCAPE_MEMO, _latex_escape, txt)
+
+
+_ACCENT_SAFE = None  # test for text nt.accent_escape leaves alone
+
+
+def _accent_safe_test():
+    # str.isascii (a flag lookup on Python 3.7+) when nitrile leaves all
+    # of ASCII alone, otherwise a regex of the characters it does
+    safe = ''.join(chr(c) for c in range(128)
+                   if nt.accent_escape(chr(c)) == chr(c))
+    if len(safe) == 128 and hasattr(str, 'isascii'):
+        return str.isascii
+    return re.compile('[{0}]*\\Z'.format(re.escape(safe))).match
+
+
+def accent_escape(txt):
+    """
+    ``nt.accent_escape`` that returns ``txt`` itself when it has nothing
+    to escape (plain ASCII code listings)
+    """
+    global _ACCENT_SAFE
+    if _ACCENT_SAFE is None:
+        _ACCENT_SAFE = _accent_safe_test()
+    if _ACCENT_SAFE(txt):
+        return txt
+    return nt.accent_escape(txt)
+
+
+# --listing-engine verbatim, LaTeX reads it faster than lstlisting
+VERBATIM_BLOCK = ('\\begin{verbatim}\n', '\n\\end{verbatim}\n\n')
+
+
+def table_size(node):
+    """
+    Rows and an estimate of the characters (rows times the width of the
+    source columns) of a table node
+    """
+    rows = width = 0
+    for tgroup in node:
+        if isinstance(tgroup, nodes.tgroup):
+            for child in tgroup:
+                if isinstance(child, nodes.colspec):
+                    width += child.get('colwidth', 0)
+                elif isinstance(child, (nodes.thead, nodes.tbody)):
+                    rows += len(child)
+    return rows, rows * width
+
+
+class TableState(object):
+    """
+    Translation state of one table: its code (see Template), the column
+    format from a ``.. longtable:`` comment (None without one), whether
+    it was made a longtable for its size, its caption and the column
+    being filled
+    """
+    def __init__(self, code, fmt=None, auto=False):
+        self.code = code
+        self.fmt = fmt
+        self.auto = auto
+        self.caption = ''
+        self.num_cols = 0
+        self.cols_seen = 0
+
+
+# tags checked while translating, each has a fixed bit in
+# NitrileTranslator.context
+CONTEXT_TAGS = ['title', 'table', 'index', 'comment', 'literal_block',
+                'reference', 'footnote', 'raw', 'entry', 'thead',
+                'admonition', 'doctest_block']
+CONTEXT_BITS = dict((name, 1 << idx) for idx, name in enumerate(CONTEXT_TAGS))
+TITLE_IN_TABLE = CONTEXT_BITS['title'] | CONTEXT_BITS['table']
+LISTING = CONTEXT_BITS['literal_block'] | CONTEXT_BITS['doctest_block']
 
 
 class NitrileTranslator(nodes.GenericNodeVisitor):
     def __init__(self, document, mapping=None):
         nodes.GenericNodeVisitor.__init__(self, document)
         self.settings = document.settings
-        self.doc = nt.Document()
-        self.in_node = {} # map of tagname to True if we are in/under this
+        if self.settings.stream_output:
+            self.doc = StreamingDocument(self.settings.stream_buffer_size)
+        else:
+            self.doc = BufferDocument()
         self.section_level = 0
+        self.section_idx = DEFAULT_SECTION_IDX + bool(self.settings.no_chapters)
+        self.add_title = self.settings.add_title
         self.saw_title = False  # only look at first title
-        self.node_mapping = mapping if mapping else MEMOIR_MAPPING
+        if mapping is None:
+            mapping = self.settings.template_file
+        # a Template from the option validator or the chapter pool is
+        # checked again only if its file changed
+        self.template = get_template(mapping)
+        if self.template.path:
+            self.settings.record_dependencies.add(self.template.path)
+        self.node_mapping = self.template.mapping
+        # verbatim takes the text as is, lstlisting needs the accents
+        # escaped
+        self.verbatim = self.settings.listing_engine == 'verbatim'
+        if self.verbatim:
+            self.node_mapping = dict(self.node_mapping,
+                                     literal_block=VERBATIM_BLOCK,
+                                     doctest_block=VERBATIM_BLOCK)
+        self.mapping_key = sorted(self.node_mapping.items())
+        # bitmask of the tags we are in/under, with a depth per tag
+        self.context = 0
+        self.depth = [0] * len(CONTEXT_TAGS)
+        self.dispatch = {}  # tagname -> entry, see add_dispatch
+        for name in self.node_mapping:
+            self.add_dispatch(name, name)
+        for attr in dir(self.__class__):
+            if attr.startswith('visit_'):
+                name = attr[len('visit_'):]
+                self.add_dispatch(nodes.Text.tagname if name == 'Text'
+                                  else name, name)
+        # tables pick their environment in visit_table, even when the
+        # mapping has one (No Starch)
+        bit, idx = self.dispatch['table'][:2]
+        self.dispatch['table'] = (bit, idx, None, self.__class__.visit_table,
+                                  self.__class__.depart_table)
         self.in_latex_role = False
         self.non_supported = False
-        self.old_table = None
-        self.table_fmt = None
+        self.tables = []  # TableState of the tables we are in
+        # column format of the next table from a ``.. longtable:``
+        # comment ('' for the default), None for automatic
+        self.next_table = None
+        # --pages-to-output ranges, with the number of sections so far and
+        # the last one output at each level while walking
+        self.pages = self.settings.pages_to_output
+        if isinstance(self.pages, (str, unicode)):
+            # settings_overrides skip the option validator
+            self.pages = parse_pages(self.pages)
+        self.section_counts = [0]
+        self.output_counts = [0]
+        self.chapter_cache = None
+        # chapters are only partly output with --pages-to-output
+        if self.settings.chapter_cache and self.pages is None:
+            self.chapter_cache = ChapterCache(
+                self.settings.chapter_cache,
+                self.settings.chapter_cache_size * 1024 * 1024)
+        self._chapter = None  # (key, outer doc) while capturing a chapter
+        self.chapter_pool = None  # set by Writer for --jobs
+        self.copy_images = True
+        self.image_stager = None  # set by Writer
+        self.staged_images = {}  # build path -> source path
+        self.chapter_images = []  # stage_image arguments since start_chapter
+        # --write-index entries, the label of the index directive we are
+        # in and where the chapter being captured started in the entries
+        self.index = LatexIndex() if self.settings.write_index else None
+        self.index_label = None
+        self.chapter_index_start = 0
+        self._index_entry = None  # (sort key, outer doc) in an index paragraph
+        # top level sections with their time for --deps-file
+        self.chapter_times = [] if self.settings.deps_file else None
+        self.chapter_started = None
+        self.image_dpi = self.settings.image_dpi
+        if self.image_dpi and load_pillow() is None:
+            document.reporter.warning(
+                '--image-dpi needs Pillow, copying images unchanged')
+            self.image_dpi = None
+        self.highlighter = None
+        self.highlighted = False  # in a highlighted literal_block
+        if self.settings.pygments_style:
+            self.setup_highlighter()
+
+    def setup_highlighter(self):
+        style = self.settings.pygments_style
+        if load_pygments() is None:
+            self.document.reporter.warning(
+                '--pygments-style needs Pygments, not highlighting code')
+            return
+        try:
+            get_style_by_name(style)
+        except ClassNotFound:
+            self.document.reporter.warning(
+                'Unknown Pygments style "{0}", not highlighting '
+                'code'.format(style))
+            return
+        self.highlighter = Highlighter(style, self.settings.pygments_cache,
+                                       self.settings.jobs)
+        bit, idx, _, _, _ = self.add_dispatch('literal_block',
+                                              'literal_block')
+        cls = self.__class__
+        self.dispatch['literal_block'] = (
+            bit, idx, None, cls.visit_highlighted_block,
+            cls.depart_highlighted_block)
 
     def at(self, nodename):
         """
         shortcut for at/under this node
         """
         if isinstance(nodename, list):
-            for name in nodename:
-                if self.in_node.get(name, False):
-                    return True
-        else:
-            return self.in_node.get(nodename, False)
+            return any(self.at(name) for name in nodename)
+        entry = self.dispatch.get(nodename)
+        return bool(entry and self.depth[entry[1]])
 
     def get_whole(self):
         return unicode(self.doc)
 
+    def add_dispatch(self, name, class_name):
+        """
+        Add the dispatch table entry for tag ``name`` (a ``class_name``
+        node): (context bit, depth index, mapping pair, visit, depart)
+        """
+        if name in self.dispatch:
+            return self.dispatch[name]
+        bit = CONTEXT_BITS.get(name, 0)
+        if bit:
+            idx = CONTEXT_TAGS.index(name)
+        else:
+            idx = len(self.depth)
+            self.depth.append(0)
+        cls = self.__class__
+        entry = self.dispatch[name] = (
+            bit, idx, self.node_mapping.get(name),
+            getattr(cls, 'visit_' + class_name, cls.unknown_visit),
+            getattr(cls, 'depart_' + class_name, cls.unknown_departure))
+        return entry
+
     def dispatch_visit(self, node):
-        # Easier just to throw nodes I'm in in a dict, than keeping
+        # Easier just to keep a bit for each tag I'm in, than keeping
         # state for each one
-        self.in_node.setdefault(node.tagname, 0)
         name = node.tagname
-        self.in_node[name] += 1
-        if name in self.node_mapping:
-            content = self.node_mapping[name][0]
-            if self.at('title') and self.at('table'):
-                self.table_caption += content
+        try:
+            bit, idx, mapped, visit, _ = self.dispatch[name]
+        except KeyError:
+            bit, idx, mapped, visit, _ = self.add_dispatch(
+                name, node.__class__.__name__)
+        self.depth[idx] += 1
+        self.context |= bit
+        if mapped is not None:
+            content = mapped[0]
+            if self.context & TITLE_IN_TABLE == TITLE_IN_TABLE:
+                self.tables[-1].caption += content
             elif content:
                 self.raw(content)
-
         else:
-            nodes.GenericNodeVisitor.dispatch_visit(self, node)
+            visit(self, node)
 
     def dispatch_departure(self, node):
-        self.in_node[node.tagname] -= 1
-        name = node.tagname
-        if name in self.node_mapping:
-            content = self.node_mapping[name][1]
-            if self.at('title') and self.at('table'):
-                self.table_caption += content
+        bit, idx, mapped, _, depart = self.dispatch[node.tagname]
+        self.depth[idx] -= 1
+        if bit and not self.depth[idx]:
+            self.context &= ~bit
+        if mapped is not None:
+            content = mapped[1]
+            if self.context & TITLE_IN_TABLE == TITLE_IN_TABLE:
+                self.tables[-1].caption += content
             elif content:
                 self.raw(content)
         else:
-            nodes.GenericNodeVisitor.dispatch_departure(self, node)
+            depart(self, node)
 
     def default_visit(self, node):
         if self.settings.report_level >= 3:
@@ -375,16 +2224,20 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
 
     def visit_index(self, node):
         entries = node.attributes['entries']
+        if self.index is not None:
+            self.index_label = node.get('targetid')
+            if self.index_label:
+                self.raw(r'\label{' + self.index_label + '}')
         if entries:
             #sphinx mode
             for entry in entries:
-                etype, values, _, _ = entry
+                etype, values, _, main = entry
                 if etype == 'pair':
                     pairs = [x.strip() for x in values.split(';')]
-                    self.add_index(', '.join(pairs))
-                    self.add_index(', '.join(pairs[::-1]))
+                    self.add_index(', '.join(pairs), main)
+                    self.add_index(', '.join(pairs[::-1]), main)
                 else:
-                    self.add_index(values)
+                    self.add_index(values, main)
         else:
             # handle in paragraphs
             # I want formatted index entries, sphinx doesn't :(
@@ -393,8 +2246,12 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
     def depart_index(self, node):
         pass
 
-    def add_index(self, name):
+    def add_index(self, name, main=''):
         # sphinx mode - not really used
+        if self.index is not None:
+            self.index.add(self.latex_escape(name), self.index_label,
+                           bool(main))
+            return
         self.raw(r'\index{')
         self.raw(name, escape=True)
         self.raw(r'}')
@@ -410,10 +2267,14 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         self.raw(r'', escape=False)
 
     def depart_document(self, node):
+        if self.highlighter:
+            # after every other preamble addition, chapters from the
+            # cache or workers included
+            self.add_preamble(self.highlighter.style_defs())
         self.raw('\n\\end{document}')
 
     def visit_title(self, node):
-        if ADD_TITLE:
+        if self.add_title:
             self.raw(r'\title{')
         # we need to skip main title,
         # preamble front matter should handle it
@@ -425,10 +2286,10 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         elif not self.saw_title:
             pass
         elif self.section_level:
-            self.doc += nt.Raw(r'{')
+            self.raw(r'{')
 
     def depart_title(self, node):
-        if ADD_TITLE:
+        if self.add_title:
             self.raw('}')
         if self.at('admonition'):
             self.raw('}')
@@ -438,65 +2299,76 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         elif not self.saw_title:
             pass
         elif self.section_level:
-            self.doc += nt.Raw('}\n')
+            self.raw('}\n')
         self.saw_title = True
 
     def visit_table(self, node):
-        self.table_caption = ''
-        self.raw(self.node_mapping['table_code'][0])
+        longtable, self.next_table = self.next_table, None
+        rows, chars = table_size(node)
+        settings = self.settings
+        auto = longtable is None and (
+            (settings.longtable_rows and rows > settings.longtable_rows) or
+            (settings.longtable_chars and chars > settings.longtable_chars))
+        if longtable is not None or auto:
+            code = self.template.long_table_code
+        else:
+            code = self.template.table_code
+        self.tables.append(TableState(code, longtable, auto))
+        self.raw(code[0])
 
     def depart_table(self, node):
-        nstr = str(node)
-        if 'Data types for' in nstr:
-            print("TABLE", nstr)
-        if self.table_caption:
-            self.table_caption = '\\caption{{{}}}'.format(self.table_caption)
-        self.raw(self.node_mapping['table_code'][1].format(self.table_caption))
-        if self.old_table:
-            self.node_mapping['table_code'] = self.old_table
-            self.old_table = None
+        table = self.tables.pop()
+        _, before, after = table.code
+        if after is None:
+            self.raw(before)
+        elif table.caption:
+            self.raw(before + '\\caption{' + table.caption + '}' + after)
+        else:
+            self.raw(before + after)
 
     def visit_Text(self, node):
-        if self.at('index'):
+        context = self.context
+        if context & CONTEXT_BITS['index']:
             # using @ helps control sorting
             # http://en.wikibooks.org/wiki/LaTeX/Indexing#Controlling_sorting
-            self.doc += nt.Raw(index_escape(node.astext()), escape=False)
-        elif self.at('comment'):
+            self.raw(self.index_escape(node.astext()))
+        elif context & CONTEXT_BITS['comment']:
             txt = node.astext()
             if txt.startswith('longtable:'):
-                if not self.old_table:
-                    self.old_table = self.node_mapping['table_code']
-                # placeholder for caption on depart needs to be before end of longtable!
-                self.node_mapping['table_code'] = self.node_mapping['long_table_code'] 
-                # specify format with
+                # the next table is a longtable, format it with
                 # .. longtable: format: { r l l p {.4\textwidth }}
+                self.next_table = ''
                 if 'format:' in txt:
-                    self.table_fmt = txt.split('format:')[-1].strip()
-
-        elif self.at('title') and self.at('table'):
-            self.table_caption += nt.escape(node.astext())
-        elif self.at('literal_block'):
-            txt = nt.accent_escape(node.astext())
-            self.doc += nt.Raw(txt, escape=False)
-        elif self.at('reference'):
+                    self.next_table = txt.split('format:')[-1].strip()
+
+        elif context & TITLE_IN_TABLE == TITLE_IN_TABLE:
+            self.tables[-1].caption += nt.escape(node.astext())
+        elif context & LISTING:
+            # the text of a listing is never backslash escaped, skip
+            # the unescaping copy astext() makes
+            txt = unicode(node)
+            if not self.verbatim:
+                txt = self.accent_escape(txt)
+            self.raw(txt)
+        elif context & CONTEXT_BITS['reference']:
             # for url
             # import pdb;pdb.set_trace()
             # self.raw(r'{')
             self.raw(node.astext(), escape=True)
             #pass
-        elif self.at('footnote'):
-            self.doc += nt.Raw(node.astext(), escape=True)
-        elif self.at('title') and not self.saw_title:
+        elif context & CONTEXT_BITS['footnote']:
+            self.raw(node.astext(), escape=True)
+        elif context & CONTEXT_BITS['title'] and not self.saw_title:
             pass
         elif self.in_latex_role:
             txt = node.astext()
             txt = txt.replace(u'Φ(x)', '\\phi(x)')
-            self.doc += nt.Raw(txt, escape=False)
+            self.raw(txt)
         elif self.non_supported:
             pass
-        elif not self.at('raw'):
+        elif not context & CONTEXT_BITS['raw']:
             # should be last
-            self.doc += nt.Raw(node.astext(), escape=True)
+            self.raw(node.astext(), escape=True)
 
     # def depart_Text(self, node):
     #     if self.at('reference'):
@@ -505,40 +2377,116 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         
     depart_Text = _dumb_depart
 
+    def block_language(self, node):
+        classes = node.get('classes', [])
+        if 'code' in classes and len(classes) > 1:
+            # from the code directive
+            return classes[classes.index('code') + 1]
+        return self.settings.pygments_language
+
+    def code_blocks(self):
+        """
+        (code, language) of the literal blocks to highlight
+        """
+        for node in _findall(self.document, nodes.literal_block):
+            language = self.block_language(node)
+            if language:
+                yield node.astext(), language
+
+    def visit_highlighted_block(self, node):
+        language = self.block_language(node)
+        latex = None
+        if language:
+            latex = self.highlighter.highlight(node.astext(), language)
+        if latex is None:
+            self.raw(self.node_mapping['literal_block'][0])
+            return
+        self.highlighted = True
+        self.raw(self.accent_escape(latex))
+        raise nodes.SkipChildren
+
+    def depart_highlighted_block(self, node):
+        if self.highlighted:
+            self.highlighted = False
+            self.raw('\n')
+        else:
+            self.raw(self.node_mapping['literal_block'][1])
+
     def visit_image(self, node):
         source_img = node.attributes['uri']
         scale = node.attributes.get('scale', None)
         width = node.attributes.get('width', '0.95')
         if '%' in width:
             width = '{:.2}'.format(int(width.replace('%', ''))/100.)
-        def abspath(source_img, source_file):
-            return os.path.abspath(os.path.join(os.path.dirname(source_file), source_img))
-        full_path = abspath(source_img, self.settings._source)
-        self.doc.add_image(source_img, full_path)
-        out_path = abspath(source_img, self.settings._destination)
-
-        try:
-            os.makedirs(os.path.dirname(out_path))
-        except OSError as e:
-            if "File exists" in str(e):
-                pass
-            else:
-                raise
-        try:
-            shutil.copy(full_path, out_path)
-        except shutil.Error as e:
-            if 'same file' in str(e):
-                pass
-            else:
-                raise
+        resample = None
+        if self.image_dpi:
+            resample = self.image_resample(width, scale)
+        graphic = self.stage_image(source_img, resample)
         if scale:
             scale = '[scale={0}]'.format(str(float(scale)/100))
         else:
             scale = r'[width={}\textwidth,height=0.9\textheight,keepaspectratio]'.format(width)  # fixme
         self.raw('\\noindent\\makebox[\\textwidth]{%\n')
-        self.raw(r'\includegraphics{0}{{'.format(scale) + source_img + '}')
+        self.raw(r'\includegraphics{0}{{'.format(scale) + graphic + '}')
 #\includegraphics[width=\textwidth,height=\textheight,keepaspectratio]{myfig.png}
 
+    def image_paths(self, source_img):
+        """
+        Return (source path, build path) for an image ``uri``
+        """
+        def abspath(source_img, source_file):
+            return os.path.abspath(os.path.join(os.path.dirname(source_file), source_img))
+        # convert() may have no source or destination file
+        destination = self.settings._destination
+        return (abspath(source_img, self.settings._source or ''),
+                destination and abspath(source_img, destination))
+
+    def image_resample(self, width, scale):
+        """
+        Return the ``(width in inches, scale, dpi)`` an image should be
+        resampled for, or None
+        """
+        if scale:
+            return (None, float(scale) / 100, self.image_dpi)
+        try:
+            width = float(width)
+        except ValueError:
+            return None
+        return (width * self.settings.image_text_width, None, self.image_dpi)
+
+    def stage_image(self, source_img, resample=None):
+        """
+        Copy (or resample) an image into the build directory and return
+        the path ``\\includegraphics`` should use
+        """
+        full_path, out_path = self.image_paths(source_img)
+        self.doc.add_image(source_img, full_path)
+        self.chapter_images.append((source_img, resample))
+        graphic = source_img
+        if resample:
+            # named after the source file, not the uri, so documents with
+            # different images under the same name (--batch) don't share
+            # one; a changed image is resampled again under the same name
+            name = hashlib.sha1(repr((full_path, resample)).encode('utf-8'))
+            graphic = '{0}/{1}{2}'.format(RESAMPLE_DIR, name.hexdigest(),
+                                          os.path.splitext(source_img)[1])
+        if not self.copy_images or out_path is None:
+            # chapter pool workers leave copying to the main process
+            return graphic
+        if resample:
+            out_path = os.path.join(
+                os.path.dirname(os.path.abspath(self.settings._destination)),
+                graphic)
+        if out_path in self.staged_images:
+            # an image used more than once is only copied once
+            return graphic
+        self.staged_images[out_path] = full_path
+        self.settings.record_dependencies.add(full_path)
+        if self.image_stager is None:
+            self.image_stager = ImageStager(0)
+        self.image_stager.stage(full_path, out_path, resample)
+        return graphic
+
     def depart_image(self, node):
         self.raw('}\n\n') # newlines so paragrahps start after image, not inline
 
@@ -548,14 +2496,25 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
             # TODO - I think paragraphs in index values messing up latex paragraph indentation
             # using @ helps control sorting
             # http://en.wikibooks.org/wiki/LaTeX/Indexing#Controlling_sorting
-            self.raw(r'''\index{'''+ index_escape(node.astext()) + "@")
+            key = self.index_escape(node.astext()) + "@"
+            if self.index is not None:
+                # capture the formatted entry for the index
+                self._index_entry = (key, self.doc)
+                self.doc = FragmentDocument()
+            else:
+                self.raw(r'''\index{'''+ key)
             self.fancy_index = True
 
     def depart_paragraph(self, node):
         if not self.at(['entry', 'index']):
             self.raw('\n\n')
         if self.at('index'):
-            self.raw(r'}')
+            if self.index is not None:
+                key, outer = self._index_entry
+                self.index.add(key + self.doc.body(), self.index_label)
+                self.doc = outer
+            else:
+                self.raw(r'}')
             self.fancy_index = False
 
     def visit_inline(self, node):
@@ -582,12 +2541,11 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         txt = node.astext()
         if node.attributes['format'] == 'latex':
             self.in_raw = True
-            self.doc +=nt.Raw(txt, escape=False)
-            self.doc +=nt.Raw('\n\n', escape=False)
+            self.raw(txt)
+            self.raw('\n\n')
         elif node.attributes['format'] == 'latexpreamble':
             self.in_raw = True
-            self.doc.preamble += nt.Raw(txt, escape=False)
-            self.doc.preamble += nt.Raw('\n\n', escape=False)
+            self.add_preamble(txt)
         else:
             self.non_supported = True
 
@@ -595,15 +2553,154 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         self.in_raw = False
         self.non_supported = False
 
+    def add_preamble(self, txt):
+        self.doc.preamble += txt
+        self.doc.preamble += '\n\n'
+
     def visit_section(self, node):
         #print("SECTION node", node, "\n*****", self.section_level, SECTIONS)
-        section = SECTIONS[DEFAULT_SECTION_IDX + self.section_level]
+        section = SECTIONS[self.section_idx + self.section_level]
+        if self.pages is not None:
+            self.filter_section(node, section)
+        if not self.section_level:
+            self.chapter_started = _timer()
+            if self.chapter_cache or self.chapter_pool:
+                self.start_chapter(node)
         self.raw('\\{0}'.format(section))  # title puts opening {
         self.section_level += 1
 
     def depart_section(self, node):
         self.raw('\n') # title puts closing {
         self.section_level -= 1
+        if self.pages is not None:
+            self.section_counts.pop()
+            self.output_counts.pop()
+        if self._chapter and not self.section_level:
+            self.end_chapter()
+        if not self.section_level:
+            self.chapter_done(node, 'translated')
+
+    def filter_section(self, node, section):
+        """
+        Skip ``node`` if it is outside ``--pages-to-output``, keeping its
+        ``latexpreamble``.  Otherwise set the LaTeX counter when earlier
+        sections were skipped so the numbering matches the whole book.
+        """
+        self.section_counts[-1] += 1
+        number = tuple(self.section_counts)
+        if not wants_section(self.pages, number):
+            for raw in _findall(node, nodes.raw):
+                if raw.get('format') == 'latexpreamble':
+                    self.add_preamble(raw.astext())
+            self.saw_title = True
+            raise nodes.SkipNode
+        if self.output_counts[-1] != number[-1] - 1:
+            self.raw('\\setcounter{{{0}}}{{{1}}}\n'.format(
+                section, number[-1] - 1))
+        self.output_counts[-1] = number[-1]
+        self.section_counts.append(0)
+        self.output_counts.append(0)
+
+    def chapter_state(self):
+        # translator state that leaks from one chapter into the next
+        return {'saw_title': self.saw_title,
+                'next_table': self.next_table}
+
+    def chapter_key(self, node, state):
+        # resampled images are named after their source files
+        image_dir = None
+        if self.image_dpi:
+            image_dir = self.image_paths('.')[0]
+        return self.chapter_cache.key(
+            node.pformat(),
+            sorted(state.items()),
+            (self.section_idx, self.add_title, self.settings.mono_font,
+             self.settings.font, self.image_dpi, image_dir,
+             self.settings.image_text_width,
+             self.highlighter and (self.highlighter.style,
+                                   pygments.__version__),
+             self.settings.pygments_language, self.settings.write_index,
+             self.settings.longtable_rows, self.settings.longtable_chars),
+            self.mapping_key)
+
+    def start_chapter(self, node):
+        """
+        Replay a top level section from the chapter cache or the chapter
+        pool (skipping its children), otherwise start capturing its
+        output for the cache
+        """
+        state = self.chapter_state()
+        key = None
+        if self.chapter_cache:
+            key = self.chapter_key(node, state)
+            entry = self.chapter_cache.get(key)
+            if entry is not None:
+                self.replay_chapter(entry)
+                self.chapter_done(node, 'cache')
+                raise nodes.SkipNode
+        if self.chapter_pool:
+            entry = self.chapter_pool.result(node, state)
+            if entry is not None:
+                if key:
+                    self.chapter_cache.put(key, entry)
+                self.replay_chapter(entry)
+                self.chapter_done(node, 'pool')
+                raise nodes.SkipNode
+        if key:
+            self._chapter = (key, self.doc)
+            self.doc = FragmentDocument()
+            self.chapter_images = []
+            if self.index is not None:
+                self.chapter_index_start = len(self.index.entries)
+
+    def chapter_done(self, node, how):
+        # how: 'translated', or replayed from the 'cache' or 'pool'
+        if self.chapter_times is None:
+            return
+        title = node.next_node(nodes.title)
+        self.chapter_times.append({
+            'title': title.astext() if title is not None else '',
+            'seconds': _timer() - self.chapter_started,
+            'how': how})
+
+    def end_chapter(self):
+        key, outer = self._chapter
+        fragment = self.doc
+        self.doc = outer
+        self._chapter = None
+        entry = self.chapter_entry(fragment)
+        self.chapter_cache.put(key, entry)
+        self.add_chapter(entry)
+        # images were already copied while capturing
+        for uri, _ in entry['images']:
+            self.doc.add_image(uri, self.image_paths(uri)[0])
+
+    def chapter_entry(self, fragment):
+        index = []
+        if self.index is not None:
+            index = self.index.entries[self.chapter_index_start:]
+        return {'body': fragment.body(),
+                'preamble': unicode(fragment.preamble),
+                'images': self.chapter_images,
+                'index': index,
+                'state': self.chapter_state()}
+
+    def add_chapter(self, entry):
+        self.doc.write(entry['body'])
+        if entry['preamble']:
+            self.doc.preamble += entry['preamble']
+
+    def replay_chapter(self, entry):
+        self.add_chapter(entry)
+        for uri, resample in entry['images']:
+            self.stage_image(uri, resample)
+        if self.index is not None:
+            self.index.entries.extend(entry['index'])
+        self.set_chapter_state(entry['state'])
+
+    def set_chapter_state(self, state):
+        self.saw_title = state['saw_title']
+        self.next_table = state['next_table']
 
     def visit_reference(self, node):
         # \href{http://www.wikibooks.org}{Wikibooks home}
@@ -614,31 +2711,36 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         #self.raw(r'\url{' + node['refuri'] + '}')
 
     def depart_reference(self, node):
-        #pass
-        print("DEP REF", node)
         self.raw('}')
 
     def visit_title_reference(self, node):
-        print("TR", node.parent)
+        pass
 
     def depart_title_reference(self, node):
         pass
 
     def visit_tgroup(self, node):
         # justify columns
-        self.num_cols = int(node['cols'])
-        if self.table_fmt:
-            self.raw(self.table_fmt + '\n')
-            self.table_fmt = None
-        elif self.old_table:
-            self.raw('{ r ' + ' l'* (self.num_cols -2)  + ' p{.4\\textwidth} }\n')
+        table = self.tables[-1]
+        table.num_cols = int(node['cols'])
+        if table.fmt:
+            self.raw(table.fmt + '\n')
+        elif table.auto:
+            # paragraph columns as wide as in the source
+            widths = [spec.get('colwidth', 1) for spec in node
+                      if isinstance(spec, nodes.colspec)]
+            total = float(sum(widths)) or 1
+            self.raw('{ ' + ' '.join('p{{{0:.2f}\\linewidth}}'.format(
+                .9 * width / total) for width in widths) + ' }\n')
+        elif table.fmt is not None:
+            self.raw('{ r ' + ' l'* (table.num_cols -2)  + ' p{.4\\textwidth} }\n')
         else:
-            self.raw('{ R ' + ' L'* (self.num_cols -1)  + ' }\n')
+            self.raw('{ R ' + ' L'* (table.num_cols -1)  + ' }\n')
 
     depart_tgroup = _dumb_depart
 
     def visit_row(self, node):
-        self.cols_seen = 0
+        self.tables[-1].cols_seen = 0
 
     def depart_row(self, node):
         self.raw(r' \\' + '\n')
@@ -651,9 +2753,10 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
     def depart_entry(self, node):
         if self.at('thead'):
             self.raw('}')
-        if self.cols_seen < self.num_cols - 1:
+        table = self.tables[-1]
+        if table.cols_seen < table.num_cols - 1:
             self.raw(' & ')  # keep track of
-        self.cols_seen += 1
+        table.cols_seen += 1
 
     def visit_label(self, node):
         self.raw('[')
@@ -683,13 +2786,209 @@ class NitrileTranslator(nodes.GenericNodeVisitor):
         """<definition_list><definition_list_item><term>An Item</term><definition><paragraph>The defintion for an item.</paragraph></definition></definition_list_item><definition_list_item><term>Second Item</term><definition><paragraph>The first paragraph for the second item.</paragraph><paragraph>Another paragraph for the item.</paragraph></definition></definition_list_item></definition_list> definition_list"""
 
     def raw(self, txt, escape=False):
-        self.doc += nt.Raw(txt, escape)
+        if escape:
+            txt = self.latex_escape(txt)
+        self.doc.write(txt)
 
+    # escaping goes through these so ProfilingTranslator can time it
+    index_escape = staticmethod(index_escape)
+    latex_escape = staticmethod(latex_escape)
+    accent_escape = staticmethod(accent_escape)
 
 
+_timer = getattr(time, 'perf_counter', time.time)
+
+
+class TranslationProfile(object):
+    """
+    Per tag call counts, total and self time and LaTeX emitted, plus
+    time spent in side effects (escaping, image staging)
+    """
+    def __init__(self):
+        self.tags = {}  # tagname -> [calls, total, self, chars]
+        self.stacks = {}  # tuple of tagnames -> self time
+        self.side_effects = {}  # name -> [calls, time]
+
+    def add_side_effect(self, name, seconds):
+        stats = self.side_effects.setdefault(name, [0, 0.0])
+        stats[0] += 1
+        stats[1] += seconds
+
+    def table(self):
+        lines = ['{0:<24} {1:>8} {2:>10} {3:>10} {4:>10}'.format(
+            'node', 'calls', 'total ms', 'self ms', 'chars')]
+        for name, (calls, total, own, chars) in sorted(
+                self.tags.items(), key=lambda item: -item[1][2]):
+            lines.append('{0:<24} {1:>8} {2:>10.1f} {3:>10.1f} {4:>10}'.format(
+                name, calls, total * 1000, own * 1000, chars))
+        for name, (calls, total) in sorted(self.side_effects.items()):
+            lines.append('{0:<24} {1:>8} {2:>10.1f}'.format(
+                '(' + name + ')', calls, total * 1000))
+        return '\n'.join(lines) + '\n'
+
+    def as_dict(self):
+        return {
+            'nodes': dict((name, {'calls': calls, 'total': total,
+                                  'self': own, 'chars': chars})
+                          for name, (calls, total, own, chars)
+                          in self.tags.items()),
+            'side_effects': dict((name, {'calls': calls, 'total': total})
+                                 for name, (calls, total)
+                                 in self.side_effects.items()),
+        }
+
+    def collapsed(self):
+        """
+        Self time per node path in microseconds, in the collapsed stack
+        format flamegraph.pl reads
+        """
+        return ''.join('{0} {1}\n'.format(';'.join(path), int(own * 1e6))
+                       for path, own in sorted(self.stacks.items()))
+
+    def write(self, filename, fmt='json'):
+        with open(filename, 'w') as fout:
+            if fmt == 'collapsed':
+                fout.write(self.collapsed())
+            else:
+                import json
+                json.dump(self.as_dict(), fout, indent=2, sort_keys=True)
+
+
+class ProfilingTranslator(NitrileTranslator):
+    """
+    NitrileTranslator that fills in a ``TranslationProfile``, used for
+    ``--profile-translate`` so the normal translator pays nothing.
+    Chapters translated by ``--jobs`` workers only show up as the time
+    spent replaying them.
+    """
+    def __init__(self, document, mapping=None):
+        NitrileTranslator.__init__(self, document, mapping)
+        self.profile = TranslationProfile()
+        self._frames = []  # [tagname, start, time in children]
+        self.index_escape = self._timed('escape', index_escape)
+        self.latex_escape = self._timed('escape', latex_escape)
+        self.accent_escape = self._timed('escape', accent_escape)
+
+    def _timed(self, name, func):
+        def timed(*args):
+            start = _timer()
+            try:
+                return func(*args)
+            finally:
+                self.profile.add_side_effect(name, _timer() - start)
+        return timed
+
+    def dispatch_visit(self, node):
+        self._frames.append([node.tagname, _timer(), 0.0])
+        try:
+            NitrileTranslator.dispatch_visit(self, node)
+        except (nodes.SkipNode, nodes.SkipDeparture):
+            # no departure coming
+            self._close_frame()
+            raise
+
+    def dispatch_departure(self, node):
+        try:
+            NitrileTranslator.dispatch_departure(self, node)
+        finally:
+            self._close_frame()
+
+    def _close_frame(self):
+        path = tuple(frame[0] for frame in self._frames)
+        name, start, children = self._frames.pop()
+        total = _timer() - start
+        stats = self.profile.tags.setdefault(name, [0, 0.0, 0.0, 0])
+        stats[0] += 1
+        stats[1] += total
+        stats[2] += total - children
+        stacks = self.profile.stacks
+        stacks[path] = stacks.get(path, 0.0) + total - children
+        if self._frames:
+            self._frames[-1][2] += total
+
+    def raw(self, txt, escape=False):
+        if escape:
+            txt = self.latex_escape(txt)
+        if self._frames:
+            self.profile.tags.setdefault(
+                self._frames[-1][0], [0, 0.0, 0.0, 0])[3] += len(txt)
+        NitrileTranslator.raw(self, txt)
+
+    def stage_image(self, source_img, resample=None):
+        start = _timer()
+        try:
+            return NitrileTranslator.stage_image(self, source_img, resample)
+        finally:
+            self.profile.add_side_effect('image staging', _timer() - start)
+
+
+def _deps_path(path):
+    # relative to the working directory (where make runs) when inside it
+    path = os.path.abspath(path)
+    try:
+        relative = os.path.relpath(path)
+    except ValueError:  # another drive
+        return path
+    return path if relative.startswith(os.pardir) else relative
+
+
+def _make_escape(path):
+    return path.replace('$', '$$').replace('#', '\\#').replace(' ', '\\ ')
 
-def index_escape(txt):
-    return txt.replace('!', '"!').replace('#', '"\#').replace('%', '\%').replace('_', '\_').replace('{', '\{').replace('}', '\}').replace('@', '"@').replace('&', r'\&').replace('^ ', r'\textasciicircum{}\enspace').replace('^', r'\textasciicircum{}').replace('~', r'\textasciitilde{}')
+
+class BuildManifest(object):
+    """
+    The files a conversion read and wrote, for ``--deps-file``: a JSON
+    manifest with their SHA-1 hashes and the time each chapter took,
+    or a Makefile ``.d`` with one rule (outputs: inputs)
+    """
+    VERSION = 1
+
+    def __init__(self):
+        self.inputs = []  # (kind, path)
+        self.outputs = []
+        self.chapters = []  # see NitrileTranslator.chapter_done
+        self.seen = set()
+
+    def add(self, files, kind, path):
+        path = _deps_path(path)
+        if path not in self.seen:
+            self.seen.add(path)
+            files.append((kind, path))
+
+    def add_input(self, kind, path):
+        self.add(self.inputs, kind, path)
+
+    def add_output(self, kind, path):
+        self.add(self.outputs, kind, path)
+
+    def describe(self, files):
+        return [{'kind': kind, 'path': path,
+                 'sha1': _file_hash(path) if os.path.exists(path) else None}
+                for kind, path in files]
+
+    def as_dict(self):
+        return {'version': self.VERSION,
+                'inputs': self.describe(self.inputs),
+                'outputs': self.describe(self.outputs),
+                'chapters': self.chapters}
+
+    def makefile(self):
+        targets = ' '.join(_make_escape(path) for _, path in self.outputs)
+        deps = [_make_escape(path) for _, path in self.inputs]
+        rules = ['{0}: {1}\n'.format(targets, ' \\\n  '.join(deps))]
+        # empty rules so make copes with a removed include or image
+        rules.extend('{0}:\n'.format(dep) for dep in deps[1:])
+        return '\n'.join(rules)
+
+    def write(self, filename, fmt='json'):
+        with io_open(filename, 'w', encoding='utf-8') as fout:
+            if fmt == 'make':
+                fout.write(self.makefile())
+            else:
+                import json
+                fout.write(unicode(json.dumps(self.as_dict(), indent=2,
+                                              sort_keys=True)))
 
 
 class BinaryFileOutput(io.FileOutput):
@@ -698,7 +2997,6 @@ class BinaryFileOutput(io.FileOutput):
     """
     def open(self):
         try:
-            print("DEST", self.destination_path)
             self.destination = open(self.destination_path, 'wb')
         except IOError as error:
             raise
@@ -711,31 +3009,939 @@ class BinaryFileOutput(io.FileOutput):
             sys.exit(1)
         self.opened = 1
 
+    def write(self, data):
+        # newer docutils only encode for text files and drop the
+        # TypeError from writing text to a binary one
+        if isinstance(data, unicode):
+            data = self.encode(data)
+        return io.FileOutput.write(self, data)
 
-def main(prog_args):
-    argv = None
-    reader = standalone.Reader()
+
+class LatexError(Exception):
+    pass
+
+
+class LatexMissing(LatexError):
+    """LaTeX or makeindex isn't installed"""
+
+
+class LatexCompiler(object):
+    """
+    Build the PDF for a .tex file in its directory.  The .aux/.toc/.idx
+    files (``AUX_EXTENSIONS``) are kept between builds; LaTeX is rerun
+    until a pass leaves them unchanged and makeindex only runs when the
+    .idx differs from the one the .ind was made from (never when
+    ``makeindex`` is None, the .ind comes from ``--write-index``).
+    Hashes from the last build are kept in ``<name>.rst2nitrile.json``
+    so an unchanged .tex with a finished build needs no pass at all.
+    """
+    AUX_EXTENSIONS = ('.aux', '.toc', '.idx', '.lof', '.lot', '.out')
+
+    def __init__(self, tex_path, latex='pdflatex', makeindex='makeindex',
+                 max_runs=5):
+        self.directory = os.path.dirname(os.path.abspath(tex_path))
+        self.jobname = os.path.splitext(os.path.basename(tex_path))[0]
+        self.tex_path = tex_path
+        self.latex = latex
+        self.makeindex = makeindex
+        self.max_runs = max_runs
+        self.stamp_path = self.path('.rst2nitrile.json')
+        self.timings = []  # (command, seconds) per pass
+
+    def path(self, extension):
+        return os.path.join(self.directory, self.jobname + extension)
+
+    def aux_hashes(self):
+        return dict((ext, _file_hash(self.path(ext)))
+                    for ext in self.AUX_EXTENSIONS
+                    if os.path.exists(self.path(ext)))
+
+    def load_stamp(self):
+        import json
+        try:
+            with open(self.stamp_path) as fin:
+                return json.load(fin)
+        except (IOError, OSError, ValueError):
+            return {}
+
+    def save_stamp(self, stamp):
+        import json
+        with open(self.stamp_path, 'w') as fout:
+            json.dump(stamp, fout, indent=2, sort_keys=True)
+
+    def call(self, name, args):
+        import subprocess
+        start = _timer()
+        try:
+            proc = subprocess.Popen(args, cwd=self.directory,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except OSError as e:
+            raise LatexMissing('Could not run {0}: {1}'.format(args[0], e))
+        output = proc.communicate()[0]
+        elapsed = _timer() - start
+        self.timings.append((name, elapsed))
+        sys.stderr.write('{0}: {1:.2f}s\n'.format(name, elapsed))
+        if proc.returncode:
+            tail = output.decode('utf-8', 'replace').splitlines()[-20:]
+            raise LatexError('{0} failed (exit {1}):\n{2}'.format(
+                name, proc.returncode, '\n'.join(tail)))
+
+    def run_latex(self, num):
+        self.call('{0} pass {1}'.format(self.latex, num),
+                  [self.latex, '-interaction=nonstopmode', '-halt-on-error',
+                   self.jobname + '.tex'])
+
+    def run_makeindex(self):
+        self.call(self.makeindex, [self.makeindex, self.jobname + '.idx'])
+
+    def run(self):
+        """
+        Run the passes needed, return the number of LaTeX passes
+        """
+        stamp = self.load_stamp()
+        tex_hash = _file_hash(self.tex_path)
+        if not self.makeindex and os.path.exists(self.path('.ind')):
+            # a written index is as much input as the .tex
+            tex_hash += _file_hash(self.path('.ind'))
+        aux = self.aux_hashes()
+        if (stamp.get('tex') == tex_hash and stamp.get('aux') == aux and
+                os.path.exists(self.path('.pdf'))):
+            sys.stderr.write('{0}.pdf is up to date\n'.format(self.jobname))
+            return 0
+        stamp = {'tex': tex_hash, 'idx': stamp.get('idx')}
+        runs = 0
+        while True:
+            if runs == self.max_runs:
+                sys.stderr.write('Cross references still changing after '
+                                 '{0} passes\n'.format(runs))
+                break
+            runs += 1
+            self.run_latex(runs)
+            before, aux = aux, self.aux_hashes()
+            idx = self.makeindex and aux.get('.idx')
+            if idx and (idx != stamp['idx'] or
+                        not os.path.exists(self.path('.ind'))):
+                self.run_makeindex()
+                stamp['idx'] = idx
+                continue  # the new .ind needs a pass
+            if aux == before:
+                break
+        stamp['aux'] = aux
+        self.save_stamp(stamp)
+        sys.stderr.write('{0} LaTeX passes, {1:.2f}s\n'.format(
+            runs, sum(seconds for _, seconds in self.timings)))
+        return runs
+
+
+class PreambleFormat(object):
+    """
+    Move the preamble of a generated .tex (everything before
+    ``\\begin{document}``) to ``<name>-preamble.tex`` and dump it to a
+    format with mylatexformat, so LaTeX passes start with the packages
+    already loaded.  The format is named after the hash of the preamble
+    and only rebuilt when that changes.  Without LaTeX (or when the
+    dump fails) the .tex just ``\\input``s the preamble.
+    """
+    BEGIN = '\\begin{document}'
+
+    def __init__(self, tex_path, latex='pdflatex'):
+        self.directory = os.path.dirname(os.path.abspath(tex_path))
+        self.jobname = os.path.splitext(os.path.basename(tex_path))[0]
+        self.preamble_name = self.jobname + '-preamble'
+        self.latex = latex
+
+    def path(self, name):
+        return os.path.join(self.directory, name)
+
+    def apply(self, text):
+        """
+        Return ``text`` loading the preamble from its own file (and the
+        format when there is one)
+        """
+        head, begin, rest = text.partition(self.BEGIN)
+        if not begin:
+            return text
+        # mylatexformat stops dumping at \endofdump; it is \relax otherwise
+        preamble = head + '\\csname endofdump\\endcsname\n'
+        self.write_preamble(preamble)
+        digest = hashlib.sha1((self.latex + preamble).encode('utf-8'))
+        format_name = '{0}-{1}'.format(self.preamble_name,
+                                       digest.hexdigest()[:12])
+        first_line = ''
+        if self.build_format(format_name):
+            first_line = '%&{0}\n'.format(format_name)
+        return (first_line + '\\input{{{0}}}\n'.format(self.preamble_name) +
+                '\\csname endofdump\\endcsname\n' + begin + rest)
+
+    def write_preamble(self, preamble):
+        filename = self.path(self.preamble_name + '.tex')
+        try:
+            with io_open(filename, encoding='utf-8') as fin:
+                if fin.read() == preamble:
+                    return  # keep the mtime
+        except (IOError, OSError):
+            pass
+        with io_open(filename, 'w', encoding='utf-8') as fout:
+            fout.write(preamble)
+
+    def build_format(self, format_name):
+        """
+        Make ``format_name.fmt`` unless it exists, remove formats of
+        older preambles.  Return True when the format can be used.
+        """
+        fmt = self.path(format_name + '.fmt')
+        failed = fmt + '-failed'
+        if os.path.exists(fmt):
+            return True
+        if os.path.exists(failed):
+            return False
+        for name in os.listdir(self.directory):
+            if (name.startswith(self.preamble_name + '-') and
+                    (name.endswith('.fmt') or name.endswith('.fmt-failed'))):
+                os.remove(self.path(name))
+        args = [self.latex, '-ini', '-interaction=nonstopmode',
+                '-jobname=' + format_name,
+                '&' + os.path.basename(self.latex), 'mylatexformat.ltx',
+                self.preamble_name + '.tex']
+        import subprocess
+        start = _timer()
+        try:
+            proc = subprocess.Popen(args, cwd=self.directory,
+                                    stdin=subprocess.PIPE,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT)
+        except OSError:
+            return False  # no LaTeX here, try again next time
+        proc.communicate()
+        if proc.returncode or not os.path.exists(fmt):
+            sys.stderr.write('Could not precompile the preamble, see '
+                             '{0}.log\n'.format(format_name))
+            open(failed, 'w').close()
+            return False
+        sys.stderr.write('Precompiled the preamble in {0:.2f}s\n'.format(
+            _timer() - start))
+        return True
+
+
+DESCRIPTION = ('Generates NiTrile/LaTex slides from '
+               'standalone reStructuredText sources.  ' + default_description)
+
+USAGE = (default_usage + '\n       %prog --batch MANIFEST [options]'
+         '\n       %prog --watch [options] <source> [<destination>]'
+         '\n       %prog --serve ADDRESS [options]')
+
+
+def make_publisher():
+    reader = Reader()
     reader_name = 'standalone'
     writer = Writer()
     writer_name = 'NiTrile'
     parser = Parser()
     parser_name = 'restructuredtext'
     settings = None
-    settings_spec = None
-    settings_overrides = None
-    config_section = None
-    enable_exit_status = 1
-    usage = default_usage
     publisher = Publisher(reader, parser, writer, settings,
                           destination_class=BinaryFileOutput)
     publisher.set_components(reader_name, parser_name, writer_name)
-    description = ('Generates NiTrile/LaTex slides from '
-                   'standalone reStructuredText sources.  ' + default_description)
+    return publisher
+
+
+def main(prog_args):
+    """
+    Read the command line once (bad options are usage errors) and
+    convert the document or run the mode it asks for
+    """
+    argv = list(prog_args[1:])
+    enable_exit_status = 1
+    publisher = make_publisher()
+    publisher.process_command_line(argv, USAGE, DESCRIPTION)
+    settings = publisher.settings
+    if settings.batch:
+        return batch_main(argv, settings)
+    if settings.watch:
+        return watch_main(argv, settings)
+    if settings.serve:
+        return serve_main(argv, settings)
+    output = publisher.publish(enable_exit_status=enable_exit_status)
+
+
+class BatchConverter(object):
+    """
+    Convert many documents in one process, sharing the command line
+    options and one reader/parser/writer setup
+    """
+    def __init__(self, argv=None):
+        self.publisher = make_publisher()
+        self.publisher.process_command_line(list(argv or []), BATCH_USAGE,
+                                            DESCRIPTION)
+        self.settings = self.publisher.settings
+
+    def convert(self, source, destination):
+        """
+        Convert ``source`` to ``destination``, return True on success
+        """
+        settings = copy.copy(self.settings)
+        settings._source = source
+        settings._destination = destination
+        # each document lists only its own includes and images
+        settings.record_dependencies = docutils.utils.DependencyList()
+        if settings.deps_file:
+            settings.deps_file = batch_deps_path(settings.deps_file,
+                                                 destination)
+        publisher = self.publisher
+        publisher.settings = settings
+        publisher.source = publisher.destination = None
+        publisher.document = None
+        try:
+            publisher.publish()
+        except SystemExit:
+            return False
+        return True
+
+
+class Converter(object):
+    """
+    Convert rst text to LaTeX text, safe to call from several threads.
+
+    The settings (option defaults and config files) are worked out
+    once, each thread keeps its own reader/parser/writer and everything
+    a conversion changes lives in its document and translator.
+    """
+    # these write files or fork, which a string conversion can't do
+    UNSUPPORTED = ('stream_output', 'compile', 'preamble_format',
+                   'write_index', 'deps_file')
+
+    def __init__(self, argv=None, **options):
+        publisher = make_publisher()
+        if argv is None:
+            self.settings = publisher.get_settings(**options)
+        else:
+            # command line options (for --serve), ``options`` are defaults
+            publisher.process_command_line(list(argv), default_usage,
+                                           DESCRIPTION, **options)
+            self.settings = publisher.settings
+        self.local = threading.local()
+
+    def check(self, settings):
+        for name in self.UNSUPPORTED:
+            if getattr(settings, name):
+                raise ValueError('{0} is not supported by convert()'.format(
+                    name))
+        if settings.jobs != 1:
+            raise ValueError('convert() translates in the calling thread, '
+                             'jobs must be 1')
+
+    def publisher(self):
+        publisher = getattr(self.local, 'publisher', None)
+        if publisher is None:
+            publisher = self.local.publisher = make_publisher()
+        return publisher
+
+    def convert(self, source, source_path=None, destination_path=None,
+                **options):
+        """
+        Return the LaTeX for the rst text ``source``.  ``options`` are
+        settings by their attribute names (``no_chapters=True``).
+        ``source_path`` is where includes and images are found,
+        images are copied next to ``destination_path`` when given.
+        Errors are raised (``docutils.utils.SystemMessage`` for
+        problems at ``halt_level``).
+        """
+        settings = copy.copy(self.settings)
+        for name, value in options.items():
+            if not hasattr(settings, name):
+                raise TypeError('Unknown option {0!r}'.format(name))
+            setattr(settings, name, value)
+        self.check(settings)
+        settings._source = source_path
+        settings._destination = destination_path
+        settings.record_dependencies = docutils.utils.DependencyList()
+        settings.traceback = True  # raise instead of exiting
+        publisher = self.publisher()
+        publisher.settings = settings
+        publisher.source = io.StringInput(source=source,
+                                          source_path=source_path)
+        publisher.destination = io.StringOutput(
+            destination_path=destination_path, encoding='unicode')
+        publisher.document = None
+        return publisher.publish()
+
+
+_CONVERTER = None  # shared by convert()
+_CONVERTER_LOCK = threading.Lock()
+
+
+def convert(source, **options):
+    """
+    Convert the rst text ``source`` to LaTeX and return it, see
+    ``Converter.convert`` for the options.  Safe to call from threads
+    (a thread pool or an asyncio executor).
+    """
+    global _CONVERTER
+    if _CONVERTER is None:
+        with _CONVERTER_LOCK:
+            if _CONVERTER is None:
+                _CONVERTER = Converter()
+    return _CONVERTER.convert(source, **options)
+
+
+def read_manifest(filename):
+    """
+    Read ``source destination`` pairs, one per line.  Blank lines and
+    lines starting with ``#`` are skipped, relative paths are relative
+    to the manifest (``-`` reads the manifest from stdin)
+    """
+    if filename == '-':
+        lines, base = sys.stdin.readlines(), os.getcwd()
+    else:
+        with open(filename) as fin:
+            lines = fin.readlines()
+        base = os.path.dirname(os.path.abspath(filename))
+    pairs = []
+    for num, line in enumerate(lines, 1):
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split()
+        if len(parts) != 2:
+            raise ValueError('{0}:{1}: expected "source destination"'.format(
+                filename, num))
+        pairs.append(tuple(os.path.join(base, part) for part in parts))
+    return pairs
+
+
+def batch_deps_path(pattern, destination):
+    """
+    The --deps-file of one --batch document: ``{}`` in ``pattern`` is
+    its destination without the extension
+
+    >>> batch_deps_path('{}.d', 'build/book.tex')
+    'build/book.d'
+    """
+    return pattern.replace('{}', os.path.splitext(destination)[0])
+
+
+BATCH_USAGE = '%prog --batch MANIFEST [--batch-jobs N] [options]'
+
+_BATCH = None  # per worker BatchConverter
+
+
+def _batch_init(argv):
+    global _BATCH
+    _BATCH = BatchConverter(argv)
+    # pool workers can't start their own chapter pools
+    _BATCH.settings.jobs = 1
+
+
+def _batch_convert(pair):
+    return _BATCH.convert(*pair)
+
+
+def batch_main(argv, settings):
+    """
+    Run ``--batch MANIFEST [--batch-jobs N]``, the other options in
+    ``argv`` apply to every document
+    """
+    jobs = settings.batch_jobs
+    if settings.deps_file and '{}' not in settings.deps_file:
+        raise SystemExit('--deps-file needs a {} for the destination with '
+                         '--batch, eg. "{}.d"')
+    try:
+        pairs = read_manifest(settings.batch)
+    except (IOError, OSError, ValueError) as e:
+        raise SystemExit('--batch: {0}'.format(e))
+    if jobs > 1:
+        import multiprocessing
+        pool = multiprocessing.Pool(jobs, _batch_init, (argv,))
+        try:
+            results = pool.map(_batch_convert, pairs, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        converter = BatchConverter(argv)
+        results = [converter.convert(*pair) for pair in pairs]
+    failed = [src for (src, dest), ok in zip(pairs, results) if not ok]
+    for src in failed:
+        sys.stderr.write('Failed to convert {0}\n'.format(src))
+    return 1 if failed else 0
+
+
+class Watcher(object):
+    """
+    Rebuild a document when it, a file it includes or an image it uses
+    changes.  Polls mtimes, so it only needs the local filesystem.
+
+    Translated chapters and image copies are kept in memory between
+    builds, so a rebuild re-parses the source but only translates the
+    chapters that changed, and an image change is handled by copying
+    that image alone.
+    """
+    def __init__(self, argv):
+        self.publisher = make_publisher()
+        self.publisher.process_command_line(list(argv), USAGE, DESCRIPTION)
+        self.settings = self.publisher.settings
+        self.interval = self.settings.watch_interval
+        if not self.settings._source or self.settings._source == '-':
+            raise SystemExit('--watch needs a source file')
+        writer = self.publisher.writer
+        if not self.settings.chapter_cache:
+            writer.chapter_cache = MemoryChapterCache()
+        writer.image_stager = ImageStager(self.settings.image_jobs,
+                                          self.settings.image_check)
+        self.stamps = {}  # watched path -> stamp
+        self.images = {}  # image source path -> build path
+
+    def build(self):
+        settings = copy.copy(self.settings)
+        settings.record_dependencies = docutils.utils.DependencyList()
+        publisher = self.publisher
+        publisher.settings = settings
+        publisher.source = publisher.destination = None
+        publisher.document = None
+        try:
+            publisher.publish()
+        except SystemExit:
+            pass
+        writer = publisher.writer
+        self.images = dict((source, out_path) for out_path, (source, _)
+                           in writer.image_stager.copies.items())
+        paths = [settings._source] + settings.record_dependencies.list
+        self.stamps = dict((os.path.abspath(path), _file_stamp(path))
+                           for path in paths)
+
+    def changed(self):
+        return [path for path, stamp in self.stamps.items()
+                if _file_stamp(path) != stamp]
+
+    def run(self):
+        self.build()
+        while True:
+            time.sleep(self.interval)
+            changed = self.changed()
+            if not changed:
+                continue
+            start = time.time()
+            if all(path in self.images for path in changed):
+                stager = self.publisher.writer.image_stager
+                for path in changed:
+                    out_path = self.images[path]
+                    stager.stage(path, out_path,
+                                 stager.resamples.get(out_path))
+                    self.stamps[path] = _file_stamp(path)
+                stager.close()
+            else:
+                self.build()
+            print('Rebuilt {0} ({1}) in {2:.2f}s'.format(
+                self.settings._destination, ', '.join(changed),
+                time.time() - start))
+
+
+def watch_main(argv, settings):
+    """
+    Run ``--watch [--watch-interval SECONDS]``
+    """
+    if settings.watch_interval <= 0:
+        raise SystemExit('--watch-interval must be positive')
+    watcher = Watcher(argv)
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+SERVE_WARMUP = 'Warm up\n=======\n\nA *short* ``document``::\n\n  code\n'
+
+_SERVE = None  # per worker Converter
+
+
+def _serve_init(argv):
+    global _SERVE
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the server stops us
+    _SERVE = Converter(argv)
+    settings = _SERVE.settings
+    settings.jobs = 1
+    # posted documents come from the network: they may not read the
+    # server's files (include, raw and csv-table with :file:) and only
+    # pass LaTeX through (\input{/etc/passwd}) when allowed
+    settings.file_insertion_enabled = False
+    settings.raw_enabled = settings.serve_allow_raw
+    # the first conversion imports and sets up the rest of docutils
+    _SERVE.convert(SERVE_WARMUP, report_level=5)
+
+
+def _serve_job(text, fmt):
+    """
+    Convert one request in a pool worker, return ``(status, content
+    type, body)``
+    """
+    try:
+        latex = _SERVE.convert(text)
+    except docutils.utils.SystemMessage as e:
+        return 422, 'text/plain', unicode(e).encode('utf-8')
+    if fmt != 'pdf':
+        return 200, 'application/x-tex; charset=utf-8', latex.encode('utf-8')
+    import tempfile
+    settings = _SERVE.settings
+    dirname = tempfile.mkdtemp(prefix='rst2nitrile-serve-')
+    try:
+        tex_path = os.path.join(dirname, 'document.tex')
+        with io_open(tex_path, 'w', encoding='utf-8') as fout:
+            fout.write(latex)
+        compiler = LatexCompiler(tex_path, settings.latex_command,
+                                 settings.makeindex_command,
+                                 settings.latex_max_runs)
+        try:
+            compiler.run()
+        except LatexMissing as e:
+            return 501, 'text/plain', unicode(e).encode('utf-8')
+        except LatexError as e:
+            return 422, 'text/plain', unicode(e).encode('utf-8')
+        with open(compiler.path('.pdf'), 'rb') as fin:
+            return 200, 'application/pdf', fin.read()
+    finally:
+        shutil.rmtree(dirname, ignore_errors=True)
+
+
+def _serve_batch(jobs):
+    results = []
+    for text, fmt in jobs:
+        start = _timer()
+        try:
+            status, content_type, body = _serve_job(text, fmt)
+        except Exception as e:  # keep the worker and the rest of the batch
+            status, content_type = 500, 'text/plain'
+            body = '{0}: {1}'.format(type(e).__name__, e).encode('utf-8')
+        results.append((status, content_type, body, _timer() - start))
+    return results
+
+
+def _percentile(values, pct):
+    return values[min(len(values) - 1, int(len(values) * pct / 100.0))]
+
+
+class ServeRequest(object):
+    def __init__(self, text, fmt):
+        self.job = (text, fmt)
+        self.start = _timer()
+        self.done = threading.Event()
+        self.result = None  # (status, content type, body, seconds)
+        self.batch = None  # the requests handed to a worker with this one
 
-    output = publisher.publish(argv, usage, description,
-                               settings_spec, settings_overrides,
-                               config_section=config_section,
-                               enable_exit_status=enable_exit_status)
+
+class ServePool(object):
+    """
+    Hand conversion requests to warm worker processes.  A worker gets
+    the requests waiting when it frees up (split between the idle
+    workers, at most ``batch_size``) in one go, and no more than
+    ``max_queue`` requests may wait, the rest are turned away.  A batch
+    whose worker fails, or that a waiting request gives up on, is
+    answered with errors and its worker slot handed on.
+    """
+    def __init__(self, argv, jobs, batch_size=8, max_queue=64, timeout=60):
+        self.jobs = jobs
+        self.batch_size = batch_size
+        self.max_queue = max_queue
+        self.timeout = timeout  # seconds before a request gets a 504
+        import multiprocessing
+        try:
+            import queue
+        except ImportError:  # Python 2
+            import Queue as queue
+        self.pool = multiprocessing.Pool(jobs, _serve_init, (argv,))
+        self.queue = queue.Queue()
+        self.slots = threading.Semaphore(jobs)
+        self.lock = threading.Lock()
+        self.busy = 0  # workers with a batch
+        self.queued = self.running = self.max_queued = 0
+        self.served = self.rejected = self.batches = self.failed = 0
+        self.pending = set()  # ids of the batches with a worker
+        self.latencies = collections.deque(maxlen=1000)  # most recent
+        self.thread = threading.Thread(target=self.dispatch)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def submit(self, text, fmt='tex'):
+        """
+        Queue a request and return it, None when the queue is full
+        """
+        with self.lock:
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return None
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+        request = ServeRequest(text, fmt)
+        self.queue.put(request)
+        return request
+
+    def dispatch(self):
+        while True:
+            self.slots.acquire()
+            request = self.queue.get()
+            if request is None:
+                break
+            batch = [request]
+            with self.lock:
+                idle = self.jobs - self.busy
+            size = min(self.batch_size, -(-(self.queue.qsize() + 1) // idle))
+            # only this thread takes from the queue, get() won't block
+            while len(batch) < size and not self.queue.empty():
+                request = self.queue.get()
+                if request is None:
+                    self.queue.put(None)
+                    break
+                batch.append(request)
+            with self.lock:
+                self.queued -= len(batch)
+                # drop the requests that gave up while waiting
+                batch = [request for request in batch if not
+                         request.done.is_set()]
+                if batch:
+                    self.busy += 1
+                    self.running += len(batch)
+                    self.pending.add(id(batch))
+                for request in batch:
+                    request.batch = batch
+            if not batch:
+                self.slots.release()
+                continue
+            kwargs = {}
+            if sys.version_info[0] > 2:  # no error_callback in Python 2
+                kwargs['error_callback'] = (
+                    lambda e, batch=batch: self.fail(batch, e))
+            self.pool.apply_async(
+                _serve_batch, ([request.job for request in batch],),
+                callback=lambda results, batch=batch: self.finish(batch,
+                                                                  results),
+                **kwargs)
+
+    def finish(self, batch, results):
+        """
+        Hand a batch's results to its requests and free its worker slot,
+        once: a batch may be failed before its worker answers
+        """
+        now = _timer()
+        with self.lock:
+            if id(batch) not in self.pending:
+                return
+            self.pending.remove(id(batch))
+            self.busy -= 1
+            self.running -= len(batch)
+            self.served += len(batch)
+            self.batches += 1
+            self.latencies.extend(now - request.start for request in batch)
+        self.slots.release()
+        for request, result in zip(batch, results):
+            request.result = result
+            request.done.set()
+
+    def fail(self, batch, error, status=500):
+        body = '{0}: {1}\n'.format(type(error).__name__, error)
+        with self.lock:
+            if id(batch) in self.pending:
+                self.failed += len(batch)
+        self.finish(batch, [(status, 'text/plain', body.encode('utf-8'), 0.0)]
+                    * len(batch))
+
+    def abandon(self, request):
+        """
+        Answer a request that waited too long with a 504, along with the
+        rest of its batch when a worker has it (the worker may be stuck
+        or gone, its slot goes to the next batch)
+        """
+        error = RuntimeError('no result after {0:.0f}s'.format(
+            _timer() - request.start))
+        with self.lock:
+            if request.batch is None and not request.done.is_set():
+                self.failed += 1
+                body = '{0}: {1}\n'.format(type(error).__name__, error)
+                request.result = (504, 'text/plain', body.encode('utf-8'),
+                                  0.0)
+                request.done.set()  # dispatch skips it
+                return
+        if request.batch is not None:
+            self.fail(request.batch, error, 504)
+
+    def stats(self):
+        with self.lock:
+            latencies = sorted(self.latencies)
+            stats = {'workers': self.jobs, 'served': self.served,
+                     'rejected': self.rejected, 'batches': self.batches,
+                     'failed': self.failed,
+                     'queued': self.queued, 'running': self.running,
+                     'max_queued': self.max_queued}
+        if latencies:
+            stats['latency'] = {
+                'mean': sum(latencies) / len(latencies),
+                'p50': _percentile(latencies, 50),
+                'p95': _percentile(latencies, 95),
+                'max': latencies[-1]}
+        return stats
+
+    def close(self):
+        self.queue.put(None)
+        self.pool.terminate()
+        self.pool.join()
+
+
+class ServeHandler(object):
+    """
+    ``POST /`` with rst (UTF-8) returns the LaTeX and ``POST /?format=pdf``
+    the PDF (501 without LaTeX).  ``GET /stats`` gives the request
+    counts, queue depth and latencies as JSON.  ``make_server`` mixes
+    it into a ``BaseHTTPRequestHandler``.
+    """
+    server_version = 'rst2nitrile'
+
+    def send(self, status, content_type, body, headers=()):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def parse_path(self):
+        """
+        Return the request's path and query arguments
+        """
+        try:
+            from urllib.parse import parse_qs, urlparse
+        except ImportError:  # Python 2
+            from urlparse import parse_qs, urlparse
+        url = urlparse(self.path)
+        return url.path, parse_qs(url.query)
+
+    def do_GET(self):
+        if self.parse_path()[0] != '/stats':
+            return self.send(404, 'text/plain', b'Not found\n')
+        import json
+        body = json.dumps(self.server.pool.stats(), indent=2, sort_keys=True)
+        self.send(200, 'application/json', body.encode('utf-8'))
+
+    def do_POST(self):
+        path, query = self.parse_path()
+        fmt = query.get('format', ['tex'])[0]
+        if path != '/' or fmt not in ('tex', 'pdf'):
+            return self.send(404, 'text/plain', b'Not found\n')
+        length = int(self.headers.get('Content-Length') or 0)
+        try:
+            text = self.rfile.read(length).decode('utf-8')
+        except UnicodeDecodeError:
+            return self.send(400, 'text/plain', b'Expected UTF-8 rst\n')
+        pool = self.server.pool
+        request = pool.submit(text, fmt)
+        if request is None:
+            return self.send(503, 'text/plain', b'Too many requests\n',
+                             [('Retry-After', '1')])
+        if not request.done.wait(pool.timeout):
+            pool.abandon(request)
+            request.done.wait()
+        status, content_type, body, seconds = request.result
+        self.send(status, content_type, body)
+        sys.stderr.write('{0} {1} {2} {3:.3f}s (converting {4:.3f}s), '
+                         '{5} queued\n'.format(
+                             self.command, self.path, status,
+                             _timer() - request.start, seconds, pool.queued))
+
+    def log_message(self, format, *args):
+        pass  # do_POST logs requests with their timings
+
+
+def make_server(address):
+    """
+    A threaded HTTP server with ``ServeHandler`` on a ``(host, port)``
+    or a Unix socket path (http.server is only imported for --serve)
+    """
+    import socket
+    try:
+        from http.server import BaseHTTPRequestHandler, HTTPServer
+        from socketserver import TCPServer, ThreadingMixIn
+    except ImportError:  # Python 2
+        from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+        from SocketServer import TCPServer, ThreadingMixIn
+
+    class Handler(ServeHandler, BaseHTTPRequestHandler):
+        pass
+
+    class Server(ThreadingMixIn, HTTPServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            if self.address_family != socket.AF_UNIX:
+                return HTTPServer.server_bind(self)
+            # HTTPServer.server_bind looks up a host name for the address
+            TCPServer.server_bind(self)
+            self.server_name = self.server_address
+            self.server_port = 0
+
+    if not isinstance(address, tuple):
+        Server.address_family = socket.AF_UNIX
+    return Server(address, Handler)
+
+
+def parse_address(text):
+    """
+    A ``PORT``, ``HOST:PORT`` or the path of a Unix socket (anything
+    with a ``/``)
+
+    >>> parse_address('8000')
+    ('127.0.0.1', 8000)
+    >>> parse_address('0.0.0.0:8000')
+    ('0.0.0.0', 8000)
+    >>> parse_address('./rst2nitrile.sock')
+    './rst2nitrile.sock'
+    """
+    if '/' in text:
+        return text
+    host, _, port = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def serve_main(argv, settings):
+    """
+    Run ``--serve ADDRESS [--serve-jobs N] [--serve-batch N]
+    [--serve-max-queue N] [--serve-timeout N] [--serve-allow-raw]``,
+    the other options in ``argv`` apply to every request
+    """
+    import json
+    import multiprocessing
+    address = settings.serve
+    jobs = settings.serve_jobs or multiprocessing.cpu_count()
+    batch_size = settings.serve_batch
+    max_queue = settings.serve_max_queue
+    timeout = settings.serve_timeout
+    unix_socket = not isinstance(address, tuple)
+    # check the options here rather than in every worker
+    converter = Converter(argv)
+    settings = copy.copy(converter.settings)
+    settings.jobs = 1
+    try:
+        converter.check(settings)
+    except ValueError as e:
+        raise SystemExit('--serve: {0}'.format(e))
+    server = make_server(address)
+    server.pool = ServePool(argv, jobs, batch_size, max_queue, timeout)
+    if not unix_socket:
+        address = '{0}:{1}'.format(*server.server_address)
+    sys.stderr.write('Serving on {0} with {1} workers\n'.format(address,
+                                                                  jobs))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.pool.close()
+        if unix_socket:
+            os.remove(address)
+    sys.stderr.write('{0}\n'.format(json.dumps(server.pool.stats(),
+                                                sort_keys=True)))
+    return 0
 
 
 def _test():